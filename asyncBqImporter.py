@@ -0,0 +1,234 @@
+from apiclient.errors import HttpError
+from bqImporter import BigQueryTimeoutException
+import httplib2
+import logging, random
+from time import time
+from uuid import uuid4
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# tornado is optional; only the async client needs it
+try:
+	from tornado import gen
+	from tornado.httpclient import HTTPRequest
+	from tornado.ioloop import IOLoop
+	from tornado.locks import Semaphore
+except ImportError:
+	gen = None
+
+# The curl client keeps connections alive, the simple one opens one per request
+if gen is not None:
+	try:
+		from tornado.curl_httpclient import CurlAsyncHTTPClient as _HTTPClient
+	except ImportError:
+		from tornado.simple_httpclient import SimpleAsyncHTTPClient as _HTTPClient
+
+# Retries of a request failing with a server error, backing off exponentially up to MAX_BACKOFF seconds
+NUM_RETRIES = 5
+MAX_BACKOFF = 64
+
+def _coroutine(fn):
+	''' tornado.gen.coroutine, or fn itself when tornado is missing (the class refuses to start then) '''
+	return gen.coroutine(fn) if gen is not None else fn
+
+class AsyncBqImporter:
+	''' Non-blocking counterpart of a BqImporter, so one thread can drive hundreds
+		of metadata calls and job polls at once
+		Requests are built by the importer's service, so URLs, bodies, responses
+		and HttpErrors are the same as the blocking calls, and sent with tornado's
+		AsyncHTTPClient, at most concurrency at once. With pycurl installed the
+		curl client is used, which keeps connections alive. The access token is
+		shared with the importer. Methods are tornado coroutines: yield them (or
+		lists of them) from a coroutine, or call them through run_sync.
+	'''
+	def __init__(self, bq, concurrency=100, request_timeout=60, min_interval=1, max_interval=30, backoff=2):
+		''' Args:
+				bq: BqImporter to share the service, credentials and metrics of
+				concurrency: maximum number of requests in flight
+				request_timeout: seconds before a request is abandoned
+				min_interval, max_interval, backoff: polling of wait_for_job backs off
+					by backoff times from min_interval to max_interval seconds
+		'''
+		if gen is None: raise ImportError('AsyncBqImporter needs tornado')
+		self._bq = bq
+		self._project_number = bq._project_number
+		self.concurrency = concurrency
+		self.request_timeout = request_timeout
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.backoff = backoff
+		self._semaphore = Semaphore(concurrency)
+		self._clients = {}
+
+	def _return_self(self):
+		return 'Async BigQuery client of project {0} ({1} requests at once, {2})'.format(
+			self._project_number, self.concurrency, _HTTPClient.__name__)
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _client(self):
+		''' Return the HTTP client of the running IOLoop '''
+		loop = IOLoop.current()
+		if loop not in self._clients: self._clients[loop] = _HTTPClient(force_instance=True, max_clients=self.concurrency)
+		return self._clients[loop]
+
+	def run_sync(self, fn, *args, **kwargs):
+		''' Run a coroutine to completion from blocking code, i.e. run_sync(self.get_table, 'dataset', 'table') '''
+		return IOLoop.current().run_sync(lambda: fn(*args, **kwargs))
+
+	@_coroutine
+	def _execute(self, request):
+		''' Send an apiclient HttpRequest and return its deserialized response
+			Server errors, rate limiting and connection failures are retried NUM_RETRIES times
+		'''
+		retries = 0
+		while True:
+			# Refreshes the shared token once it has expired
+			self._bq._authorize()
+			headers = dict(request.headers)
+			self._bq._credentials.apply(headers)
+			started = time()
+			with (yield self._semaphore.acquire()):
+				response = yield self._client().fetch(HTTPRequest(
+					request.uri
+					,method=request.method
+					,headers=headers
+					,body=request.body
+					,request_timeout=self.request_timeout
+				), raise_error=False)
+			if self._bq.metrics: self._bq.metrics.record_call(request.methodId, time() - started, error=response.code >= 400)
+			if (response.code >= 500 or response.code == 429) and retries < NUM_RETRIES:
+				retries += 1
+				sleeptime = random.random() * min(MAX_BACKOFF, 2**retries)
+				logger.warning('{0} failed with status {1}, retry #{2} in {3:.1f} seconds'.format(request.methodId, response.code, retries, sleeptime))
+				yield gen.sleep(sleeptime)
+				continue
+			# 599: no response at all
+			if response.code == 599: raise response.error
+			resp = httplib2.Response(dict(response.headers.items(), status=str(response.code)))
+			raise gen.Return(request.postproc(resp, response.body))
+
+	@_coroutine
+	def get_table(self, dataset, table, warn_missing=True):
+		''' Retrieve a table if it exists, None if it does not '''
+		try:
+			resource = yield self._execute(self._bq._service.tables().get(
+				projectId=self._project_number
+				,datasetId=dataset
+				,tableId=table
+			))
+		except HttpError, e:
+			if int(e.resp['status']) == 404:
+				if warn_missing: logger.warning('Table %s.%s does not exist', dataset, table)
+				raise gen.Return(None)
+			raise
+		raise gen.Return(resource)
+
+	@_coroutine
+	def check_table(self, dataset, table, warn_missing=True):
+		''' Check to see if a table exists '''
+		resource = yield self.get_table(dataset, table, warn_missing)
+		raise gen.Return(bool(resource))
+
+	@_coroutine
+	def get_tables(self, datasetId):
+		''' Return all table IDs of a dataset, following every page of the listing '''
+		tables, page_token = [], None
+		while True:
+			res = yield self._execute(self._bq._service.tables().list(
+				projectId=self._project_number
+				,datasetId=datasetId
+				,pageToken=page_token
+			))
+			tables += [ '{0}'.format(t['tableReference']['tableId']) for t in res.get('tables', []) ]
+			page_token = res.get('nextPageToken')
+			if not page_token: raise gen.Return(tables)
+
+	@_coroutine
+	def get_jobinfo(self, job_id):
+		''' Return the resource of a job '''
+		job = yield self._execute(self._bq._service.jobs().get(projectId=self._project_number, jobId=job_id))
+		raise gen.Return(job)
+
+	@_coroutine
+	def job_isfinished(self, job_id):
+		''' Check to see if complete status is true '''
+		results = yield self.get_query_results(job_id, max_results=0)
+		raise gen.Return(results.get('jobComplete', False))
+
+	@_coroutine
+	def get_query_results(self, job_id, start_index=0, max_results=None, page_token=None, timeout_ms=0):
+		''' Return a page of the results of a query job (jobComplete is False until it is done) '''
+		results = yield self._execute(self._bq._service.jobs().getQueryResults(
+			projectId=self._project_number
+			,jobId=job_id
+			,startIndex=start_index if page_token is None else None
+			,maxResults=max_results
+			,pageToken=page_token
+			,timeoutMs=timeout_ms
+		))
+		raise gen.Return(results)
+
+	@_coroutine
+	def insert_job(self, body):
+		''' Insert a job and return its resource, tracking it as active in the importer 
+			Jobs without a jobReference are given a job id first, so a retried insert 
+			cannot start the job twice
+		'''
+		body = dict(body, jobReference=body.get('jobReference') or {'projectId': self._project_number, 'jobId': 'job_{0}'.format(uuid4().hex)})
+		job_id = body['jobReference']['jobId']
+		try:
+			job_resource = yield self._execute(self._bq._service.jobs().insert(projectId=self._project_number, body=body))
+		except HttpError, e:
+			# The insert went through before the request that was retried failed
+			if int(e.resp['status']) != 409: raise
+			job_resource = yield self.get_jobinfo(job_id)
+		self._bq._active_jobs.append(job_id)
+		raise gen.Return(job_resource)
+
+	@_coroutine
+	def query_to_table(self, query, datasetId, tableId, allow_large_results=True, maximum_bytes_billed=None):
+		''' Write a query result to a table, returning the job id (see BqImporter.query_to_table) '''
+		logger.warning('Writing to table {0}.{1}'.format(datasetId, tableId))
+		job_resource = yield self.insert_job(self._bq._query_job(query, datasetId, tableId, allow_large_results, maximum_bytes_billed))
+		raise gen.Return(job_resource['jobReference']['jobId'])
+
+	@_coroutine
+	def export_data_to_uris(self, destination_uris, dataset, table, job=None, compression=None, destination_format=None, print_header=None, field_delimiter=None):
+		''' Export a table to cloud storage, returning the job resource (see BqImporter.export_data_to_uris) '''
+		body = self._bq._extract_job(destination_uris, dataset, table, job, compression, destination_format, print_header, field_delimiter)
+		logger.warning('Creating export job {0}'.format(body['jobReference']['jobId']))
+		job_resource = yield self.insert_job(body)
+		raise gen.Return(job_resource)
+
+	@_coroutine
+	def wait_for_job(self, job_id, timeout=None):
+		''' Poll a job until it is done and return its resource, raising if it failed
+			Polling backs off (with jitter) from min_interval to max_interval seconds
+			Raises BigQueryTimeoutException after timeout seconds
+		'''
+		deadline = time() + timeout if timeout is not None else None
+		interval = self.min_interval
+		while True:
+			job_resource = yield self.get_jobinfo(job_id)
+			if job_resource.get('status', {}).get('state') == 'DONE': break
+			if deadline is not None and time() >= deadline:
+				logger.error('BigQuery job %s timeout' % job_id)
+				raise BigQueryTimeoutException('BigQuery job {0} timeout'.format(job_id))
+			sleeptime = random.uniform(interval / 2.0, interval)
+			yield gen.sleep(sleeptime if deadline is None else max(0, min(sleeptime, deadline - time())))
+			interval = min(interval * self.backoff, self.max_interval)
+		if job_id in self._bq._active_jobs: self._bq._active_jobs.remove(job_id)
+		if self._bq.metrics: self._bq.metrics.record_job(job_resource)
+		self._bq._raise_executing_exception_if_error(job_resource)
+		raise gen.Return(job_resource)
+
+	@_coroutine
+	def wait_for_jobs(self, job_ids, timeout=None):
+		''' Wait for every job at once and return their resources, raising on the first failure '''
+		job_resources = yield [ self.wait_for_job(j, timeout) for j in job_ids ]
+		raise gen.Return(job_resources)
@@ -0,0 +1,149 @@
+from bigquery_runner import parser, run_pipeline, check_options, get_option, table_cache_from_config, discovery_from_config, write_metrics, STAGES
+from metrics import Metrics
+from bqImporter import BqImporter
+from gsDownloader import GsDownloader
+from multiprocessing.pool import ThreadPool
+import logging, shlex, sys, threading
+import ConfigParser
+from optparse import OptionParser
+
+# Enable logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Set command-line parser options
+batch_parser = OptionParser(usage='%prog [options] [spec ...]')
+batch_parser.add_option('-b','--batch',action='store',type='string',dest='batch',default='batch.ini',help='Read specs from batch file',metavar='batch.ini')
+
+class BatchRunner:
+	''' Run many (template, date range, destination) specs from one process
+		Specs sharing a service account and project share one BqImporter and
+		GsDownloader, and every spec shares the dataset listings of the others.
+		Specs run concurrently, but each pipeline stage (see bigquery_runner.STAGES)
+		is limited to a number of specs at once across the whole batch.
+	'''
+	def __init__(self, specs, limits=None, concurrency=None, metrics=None):
+		''' Args:
+				specs: list of (name, options, config) tuples, with options parsed by
+					bigquery_runner's parser and the config file read
+				limits: dict of the maximum number of specs in each stage at once (default 1)
+				concurrency: maximum number of specs in flight (default all of them)
+				metrics: optional Metrics to record the whole batch in
+		'''
+		self.specs = specs
+		self.limits = dict((stage,threading.Semaphore((limits or {}).get(stage,1))) for stage in STAGES)
+		self.concurrency = concurrency or len(specs)
+		self.table_lists = {}
+		self.metrics = metrics
+		self._clients = {}
+		self._check_destinations()
+
+	def _return_self(self):
+		return 'Batch of {0} specs: {1}'.format(len(self.specs),','.join([ n for n,_,_ in self.specs ]))
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _check_destinations(self):
+		''' Refuse specs that would write the same BigQuery table, Cloud Storage object, local file 
+			or Vertica table (whose staging table they would share) 
+		'''
+		seen = {}
+		for name, options, config in self.specs:
+			targets = [
+				'BigQuery table {0}.{1}'.format(config.get('BigQuery','bq_dataset'),config.get('BigQuery','bq_table'))
+				,'object gs://{0}/{1}'.format(config.get('GoogleStorage','gs_bucket'),config.get('GoogleStorage','gs_dest_object'))
+			]
+			if options.vertica: targets += ['file {0}'.format(config.get('Destination','destination_file')),'Vertica table {0}'.format(config.get('Destination','vertica_table'))]
+			for target in targets:
+				if target in seen: raise ValueError('Specs {0} and {1} both write {2}'.format(seen[target],name,target))
+				seen[target] = name
+
+	def clients(self, config):
+		''' Return the (BqImporter, GsDownloader) of a config's connection, created once per account and project '''
+		key_file = config.get('Connection','Key_File')
+		conn = (config.get('Connection','Service_Account_Email'),config.get('Connection','Project_Number'),key_file)
+		if conn not in self._clients:
+			KEY = file(key_file).read()
+			discovery = discovery_from_config(config)
+			self._clients[conn] = (
+				BqImporter(conn[0], conn[1], KEY, cache=table_cache_from_config(config), discovery=discovery, metrics=self.metrics)
+				,GsDownloader(conn[0], KEY, discovery=discovery, metrics=self.metrics)
+			)
+		return self._clients[conn]
+
+	def run_spec(self, spec):
+		''' Run one spec, returning the exception it failed with (if any) instead of raising it '''
+		name, options, config = spec
+		bq, gs = self.clients(config)
+		try:
+			run_pipeline(options,config,bq=bq,gs=gs,table_lists=self.table_lists,limits=self.limits,metrics=self.metrics)
+		except Exception as e:
+			logger.exception('Spec {0} failed'.format(name))
+			return e
+		logger.warning('Spec {0} finished'.format(name))
+
+	def run(self):
+		''' Run every spec and return the names of the ones that failed '''
+		# Log in once per connection before any spec starts
+		for _, _, config in self.specs: self.clients(config)
+		pool = ThreadPool(max(1,min(self.concurrency,len(self.specs))))
+		try:
+			errors = pool.map(self.run_spec,self.specs)
+		finally:
+			pool.close()
+			pool.join()
+		failed = [ name for (name,_,_),error in zip(self.specs,errors) if error is not None ]
+		logger.warning('Batch finished: {0} of {1} specs succeeded{2}'.format(
+			len(self.specs)-len(failed),len(self.specs),', failed: '+','.join(failed) if failed else ''))
+		return failed
+
+def load_specs(path, names=None):
+	''' Read the specs of a batch file
+		Every section but [Batch] and [Metrics] is a spec, whose args option holds the
+		bigquery_runner command line of that run, i.e. -c web_sessions.ini -s 2016-01-01 -v -d
+		Args:
+			names: optional list of spec names to keep (default all)
+		Returns (specs, batch config)
+	'''
+	batch = ConfigParser.RawConfigParser()
+	if not batch.read(path): raise ValueError('Cannot read batch file {0}'.format(path))
+	specs = []
+	for name in batch.sections():
+		if name in ('Batch','Metrics') or (names and name not in names): continue
+		options, args = parser.parse_args(shlex.split(batch.get(name,'args')))
+		config = ConfigParser.RawConfigParser()
+		if not config.read(options.config): raise ValueError('Spec {0}: cannot read config file {1}'.format(name,options.config))
+		try:
+			check_options(options,config)
+		except ValueError as e:
+			raise ValueError('Spec {0}: {1}'.format(name,e))
+		specs.append((name,options,config))
+	if names and len(specs)!=len(names): raise ValueError('Unknown specs: {0}'.format(','.join(set(names)-set([ n for n,_,_ in specs ]))))
+	return specs, batch
+
+def main(parse_args):
+	''' Run every spec of a batch file, or only the ones named on the command line '''
+	(options, args) = parse_args.parse_args()
+	try:
+		specs, batch = load_specs(options.batch, args)
+		runner = BatchRunner(
+			specs
+			,limits=dict((stage,get_option(batch,'Batch','{0}_concurrency'.format(stage),1,int)) for stage in STAGES)
+			,concurrency=get_option(batch,'Batch','spec_concurrency',None,int)
+			,metrics=Metrics(run={'batch': options.batch, 'specs': [ n for n,_,_ in specs ]})
+		)
+	except ValueError as e:
+		parse_args.error(str(e))
+	logger.warning('Starting {0}'.format(runner))
+	try:
+		failed = runner.run()
+	finally:
+		write_metrics(runner.metrics,batch)
+	if failed: sys.exit(1)
+
+if __name__=='__main__':
+	main(batch_parser)
@@ -0,0 +1,216 @@
+from fakeServices import FakeGoogle, write_fake_vsql
+from bqImporter import BqImporter
+from gsDownloader import GsDownloader
+from bigquery_runner import BigQueryRunner
+from copy_into_vertica import VerticaCopyRunner
+from discovery import DiscoveryCache
+from oauth2client.client import AccessTokenCredentials
+from datetime import datetime, timedelta
+from json import dumps, loads
+from time import time
+import logging, os, sys, gzip, shutil, tempfile
+from optparse import OptionParser
+
+# Enable logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = ('table_list','table_probe','job_polling','download','vertica_copy')
+
+# Set command-line parser options
+parser = OptionParser(usage='%prog [options]')
+parser.add_option('-b','--benchmarks',action='store',type='string',dest='benchmarks',default=','.join(BENCHMARKS),help='Comma-separated benchmarks to run',metavar=','.join(BENCHMARKS))
+parser.add_option('--datasets',action='store',type='int',dest='datasets',default=10,help='Datasets listed by table_list and probed by table_probe',metavar='10')
+parser.add_option('--days',action='store',type='int',dest='days',default=1000,help='Daily tables in every dataset',metavar='1000')
+parser.add_option('--jobs',action='store',type='int',dest='jobs',default=50,help='Jobs polled at once by job_polling',metavar='50')
+parser.add_option('--job-seconds',action='store',type='float',dest='job_seconds',default=5,help='Seconds until a fake job is done',metavar='5')
+parser.add_option('--object-mb',action='store',type='int',dest='object_mb',default=256,help='Size of the object downloaded by download',metavar='256')
+parser.add_option('--workers',action='store',type='int',dest='workers',default=4,help='Workers of the ranged download',metavar='4')
+parser.add_option('--files',action='store',type='int',dest='files',default=4,help='Files copied by vertica_copy',metavar='4')
+parser.add_option('--rows',action='store',type='int',dest='rows',default=200000,help='Rows in every file of vertica_copy',metavar='200000')
+parser.add_option('--parallelism',action='store',type='int',dest='parallelism',default=2,help='Files copied at once by vertica_copy',metavar='2')
+parser.add_option('--latency',action='store',type='float',dest='latency',default=0,help='Milliseconds every fake API call takes',metavar='0')
+parser.add_option('-o','--output',action='store',type='string',dest='output',default=None,help='Write the results as JSON',metavar='results.json')
+parser.add_option('-B','--baseline',action='store',type='string',dest='baseline',default=None,help='Compare with the results of an earlier run, failing on regressions',metavar='baseline.json')
+parser.add_option('-T','--tolerance',action='store',type='float',dest='tolerance',default=1.25,help='Times slower than the baseline a benchmark may be (default 1.25)',metavar='1.25')
+
+# Fake project, bucket and credentials the clients use against the fake services
+PROJECT = 'bench'
+BUCKET = 'bench-bucket'
+CREDENTIALS = AccessTokenCredentials('fake-token', 'bqimporter-benchmark')
+
+class Benchmarks:
+	''' Time the importer's own overhead against local stand-ins for BigQuery,
+		Cloud Storage and vsql (see fakeServices), so the numbers are repeatable
+		and reflect this code rather than the network or the services
+		Every benchmark returns a dict of its measurements, with the wall time in
+		seconds and the API calls it made per method in calls.
+	'''
+	def __init__(self, options):
+		''' Args:
+				options: options parsed by parser
+		'''
+		self.options = options
+		self.google = FakeGoogle(project=PROJECT, job_seconds=options.job_seconds, latency=options.latency / 1000.0)
+		self.workdir = None
+
+	def _return_self(self):
+		return 'Benchmarks: {0}'.format(self.options.benchmarks)
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def __enter__(self):
+		self.google.start()
+		self.workdir = tempfile.mkdtemp(prefix='bqimporter-benchmark-')
+		self.discovery = DiscoveryCache(root_url=self.google.url)
+		return self
+
+	def __exit__(self, *exc):
+		self.google.stop()
+		shutil.rmtree(self.workdir, ignore_errors=True)
+
+	def bq(self):
+		''' Return a fresh BqImporter of the fake BigQuery '''
+		return BqImporter(None, PROJECT, None, discovery=self.discovery, credentials=CREDENTIALS)
+
+	def gs(self):
+		''' Return a fresh GsDownloader of the fake Cloud Storage '''
+		return GsDownloader(None, None, discovery=self.discovery, credentials=CREDENTIALS)
+
+	def timed(self, name, fn):
+		''' Run fn once, returning its measurements with the seconds and API calls it took '''
+		self.google.calls(reset=True)
+		logger.warning('Running benchmark {0}'.format(name))
+		started = time()
+		result = fn() or {}
+		result.update(benchmark=name, seconds=time() - started, calls=self.google.calls())
+		logger.warning('Benchmark {0}: {1:.2f}s, {2} API calls'.format(name, result['seconds'], sum(result['calls'].values())))
+		return result
+
+	def _runner(self, name, **kwargs):
+		''' Return a BigQueryRunner over the whole range of datasets of daily tables '''
+		days, datasets = self.options.days, [ 'dataset_{0:03d}'.format(n) for n in range(self.options.datasets) ]
+		for d in datasets: self.google.add_daily_tables(d, 'ga_sessions_', days)
+		today = datetime.now().date()
+		return BigQueryRunner('bench', name, str(today - timedelta(days=days - 1)), str(today), [], r'ga_sessions_(?P<datenum>\d{8})'
+			,'SELECT * FROM [{0}.{1}]', 'SELECT * FROM {0}', dict((d,n) for n,d in enumerate(datasets)), PROJECT, None, None, []
+			,bq=self.bq(), **kwargs)
+
+	def _union(self, name, runner):
+		''' Time building the union of every table in the range '''
+		expected = self.options.days * self.options.datasets
+		tables = self.timed(name, lambda: {'tables': runner.create_table_list().count('[')})
+		if tables['tables'] != expected: raise Exception('Found {0} of {1} tables'.format(tables['tables'], expected))
+		return tables
+
+	def table_list(self):
+		''' List datasets of thousands of daily tables and build the union of the whole range '''
+		return self._union('table_list', self._runner('table_list'))
+
+	def table_probe(self):
+		''' Look up every daily table of the range by name (in batch requests) and build their union '''
+		return self._union('table_probe', self._runner('table_probe', table_name='ga_sessions_{0:%Y%m%d}', probe_tables=True))
+
+	def job_polling(self):
+		''' Start many query jobs at once and wait for all of them with the job manager '''
+		bq = self.bq()
+		def run():
+			jobs = [ bq.query_to_table('SELECT 1', 'bench', 'polling_{0}'.format(n)) for n in range(self.options.jobs) ]
+			bq.jobs.wait([ bq.jobs.track(j) for j in jobs ])
+			return {'jobs': len(jobs)}
+		result = self.timed('job_polling', run)
+		# Time spent waiting after the last job was done, beyond the time to start them all
+		result['overshoot_seconds'] = result['seconds'] - self.options.job_seconds
+		return result
+
+	def download(self):
+		''' Download one large object in chunks, then with ranged requests, both verified '''
+		obj = self.google.add_object(BUCKET, 'bench/download.csv.gz', self.options.object_mb * 1024 * 1024)
+		obj.md5()
+		destination = os.path.join(self.workdir, 'download.csv.gz')
+		results = []
+		for name, fn in (('download', lambda gs: gs.download(BUCKET, obj.name, destination))
+				,('download_ranged', lambda gs: gs.download_ranged(BUCKET, obj.name, destination, self.options.workers))):
+			gs = self.gs()
+			result = self.timed(name, lambda: fn(gs) and None)
+			result['bytes'] = obj.size
+			result['bytes_per_second'] = obj.size / result['seconds']
+			results.append(result)
+			os.remove(destination)
+		return results
+
+	def _write_files(self):
+		''' Write the gzip CSV files of vertica_copy, returning their paths and total rows '''
+		files = [ os.path.join(self.workdir, 'copy_{0}.csv.gz'.format(n)) for n in range(self.options.files) ]
+		line = ';'.join(['2016-01-01', 'some-visitor-id', '12345', 'http://example.com/a/page']) + '\r\n'
+		for path in files:
+			f = gzip.open(path, 'wb')
+			try:
+				for _ in xrange(self.options.rows / 1000): f.write(line * 1000)
+				f.write(line * (self.options.rows % 1000))
+			finally:
+				f.close()
+		return files, self.options.rows * len(files)
+
+	def vertica_copy(self):
+		''' Copy gzip files into Vertica with the fake vsql, from the files, then streamed through stdin '''
+		files, rows = self._write_files()
+		write_fake_vsql(self.workdir)
+		path = os.environ['PATH']
+		os.environ['PATH'] = self.workdir + os.pathsep + path
+		try:
+			runner = lambda: VerticaCopyRunner('bench.copy', ['day','visitor','hits','page'], files, parallelism=self.options.parallelism, hosts=['bench-1','bench-2'])
+			def stream(file):
+				def writer(pipe):
+					with open(file, 'rb') as f: shutil.copyfileobj(f, pipe, 1024 * 1024)
+				return writer
+			results = [
+				self.timed('vertica_copy', lambda: {'rows': runner().run()['rows_loaded']})
+				,self.timed('vertica_stream', lambda: {'rows': runner().run_stream([ stream(f) for f in files ])['rows_loaded']})
+			]
+		finally:
+			os.environ['PATH'] = path
+		for r in results:
+			if r['rows'] != rows: raise Exception('Benchmark {0} loaded {1} of {2} rows'.format(r['benchmark'], r['rows'], rows))
+		return results
+
+	def run(self):
+		''' Run the benchmarks named in the options, returning all their results '''
+		results = []
+		for name in self.options.benchmarks.split(','):
+			if name not in BENCHMARKS: raise ValueError('Unknown benchmark {0}'.format(name))
+			result = getattr(self, name)()
+			results += result if isinstance(result, list) else [result]
+		return results
+
+def compare(results, baseline, tolerance):
+	''' Return the names of the benchmarks more than tolerance times slower than in baseline '''
+	before = dict((r['benchmark'], r['seconds']) for r in baseline)
+	slower = []
+	for r in results:
+		if r['benchmark'] not in before: continue
+		ratio = r['seconds'] / before[r['benchmark']] if before[r['benchmark']] else 1
+		logger.warning('Benchmark {0}: {1:.2f}s, was {2:.2f}s ({3:+.0%})'.format(r['benchmark'], r['seconds'], before[r['benchmark']], ratio - 1))
+		if ratio > tolerance: slower.append(r['benchmark'])
+	return slower
+
+def main(parse_args):
+	''' Run the benchmarks, optionally failing if any regressed against a baseline '''
+	(options, args) = parse_args.parse_args()
+	with Benchmarks(options) as benchmarks:
+		results = benchmarks.run()
+	if options.output:
+		with open(options.output, 'w') as f: f.write(dumps(results, indent=1, sort_keys=True))
+		logger.warning('Wrote benchmark results to {0}'.format(options.output))
+	if options.baseline:
+		with open(options.baseline, 'r') as f: slower = compare(results, loads(f.read()), options.tolerance)
+		if slower:
+			logger.error('Slower than the baseline: {0}'.format(','.join(slower)))
+			sys.exit(1)
+
+if __name__=='__main__':
+	main(parser)
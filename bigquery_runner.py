@@ -1,9 +1,18 @@
-from bqImporter import BqImporter
+from bqImporter import BqImporter, BATCH_SIZE
 from gsDownloader import GsDownloader
 from copy_into_vertica import VerticaCopyRunner
-from re import match 
-import logging, os, imp
+from tableCache import TableListCache
+from stateStore import LoadStateStore
+from checkpoint import Checkpoint
+from discovery import DiscoveryCache
+from resultCache import QueryResultCache
+from metrics import Metrics, timed
+from re import match, escape, compile as compile_re
+from multiprocessing.pool import ThreadPool
+import logging, os, imp, Queue, threading
+from hashlib import md5, sha256
 from datetime import datetime
+from time import time
 from dateutil.relativedelta import relativedelta
 import ConfigParser
 from optparse import OptionParser
@@ -16,19 +25,39 @@ logger = logging.getLogger(__name__)
 parser = OptionParser()
 config = ConfigParser.RawConfigParser()
 parser.add_option('-c','--config',action='store',type='string',dest='config',default='config.ini',help='Read from config file',metavar='config.ini')
-parser.add_option('-s','--startdt',action='store',type='string',dest='startdt',default=str(datetime.date(datetime.now()-relativedelta(days=1))),help='Set the starting date',metavar='YYYY-MM-DD')
+parser.add_option('-s','--startdt',action='store',type='string',dest='startdt',default=None,help='Set the starting date (default yesterday, or incremental_lookback_days ago with -n)',metavar='YYYY-MM-DD')
 parser.add_option('-e','--enddt',action='store',type='string',dest='enddt',default=str(datetime.date(datetime.now())),help='Set the ending date',metavar='YYYY-MM-DD')
 parser.add_option('-x',action='store_true',dest='drop',default=False,help='Drop the destination table in BigQuery before running (if schema changes)')
 parser.add_option('-v',action='store_true',dest='vertica',default=False,help='Import into Vertica')
 parser.add_option('-t',action='store_true',dest='truncate',default=False,help='Truncate Vertica table before loading')
 parser.add_option('-d',action='store_true',dest='dedupe',default=False,help='Dedupe Vertica table after loading')
+parser.add_option('-n',action='store_true',dest='incremental',default=False,help='Only process the days with daily tables that are new or changed since they were last loaded (with -v, needs -P or -i)')
+parser.add_option('-P',action='store_true',dest='partitions',default=False,help='Replace only the Vertica date partitions from startdt to enddt')
+parser.add_option('-i',action='store_true',dest='incremental_dedupe',default=False,help='Load through a staging table and only add rows not already in the Vertica table')
+parser.add_option('-k','--chunk-days',action='store',type='int',dest='chunk_days',default=None,help='Query the date range in parallel chunks of this many days',metavar='7')
+parser.add_option('-w',action='store_true',dest='sharded',default=False,help='Export to sharded wildcard objects and download them in parallel')
+parser.add_option('-r',action='store_true',dest='ranged',default=False,help='Download the export object with parallel range requests')
+parser.add_option('-S',action='store_true',dest='stream',default=False,help='Stream the export straight into Vertica without a local file')
+parser.add_option('-D',action='store_true',dest='dry_run',default=False,help='Only report the bytes the queries would scan, without running them')
+parser.add_option('-p',action='store_true',dest='probe',default=False,help='Look up daily tables by name (TABLE_NAME in template) instead of listing datasets')
+
+class ByteBudgetExceeded(Exception):
+	''' Raised when a query would scan more than the byte budget '''
+	pass
+
+def format_bytes(n):
+	''' Return a byte count in readable units, i.e. 1.5 TB '''
+	if n<1000: return '{0} B'.format(n)
+	for unit in ('KB','MB','GB','TB'):
+		n /= 1000.0
+		if n<1000 or unit=='TB': return '{0:.1f} {1}'.format(n,unit)
 
 class BigQueryRunner:
 	''' Class to combine all functions into a script that will execute queries in 
 		BiqQuery using predefined query templates and dataset keys, with 
 		a schema defined for the flattened output
 	'''
-	def __init__(self,dataset,table,startdt,enddt,schema,table_match_re,template,final_step,dataset_keys,project_number,service_account_email,key,uris,drop_before=False):
+	def __init__(self,dataset,table,startdt,enddt,schema,table_match_re,template,final_step,dataset_keys,project_number,service_account_email,key,uris,drop_before=False,discovery_concurrency=8,table_cache=None,table_name=None,probe_tables=False,chunk_days=None,chunk_concurrency=4,chunk_retries=1,state=None,state_key=None,checkpoint=None,bq=None,table_lists=None,discovery=None,dry_run=False,byte_budget=None,budget_action='refuse',result_cache=None,direct_read_max_bytes=None,metrics=None):
 		''' Initialize query runner object
 			Args: 
 				dataset: destination datasetId (should already exist)
@@ -45,23 +74,69 @@ class BigQueryRunner:
 				key: p12 key from Google, for login
 				uris: Google storage URIs (for transferring query results - not optional)
 				drop_before: boolean to drop table prior to running query (in case of schema change, set to true)
+				discovery_concurrency: max number of datasets listed at once (1 lists them serially)
+				table_cache: optional TableListCache to persist table listings between runs
+				table_name: format string building a daily table name from a date, i.e. 'web_sessions_{0:%Y%m%d}'
+				probe_tables: boolean to look up the table_name tables in the date range instead of listing datasets
+				chunk_days: split the date range into chunks of this many days, each queried by its own job
+					(final_step must give the same result when run per chunk and union'd, i.e. no aggregation across days)
+				chunk_concurrency: max number of chunk query jobs running at once
+				chunk_retries: number of times a failed chunk is resubmitted
+				state: optional LoadStateStore; only tables new or changed since they were last loaded are processed
+					(the caller marks pending_tables loaded once the load succeeds)
+				state_key: destination name the state is kept under (default dataset.table)
+				checkpoint: optional Checkpoint; the table listing and BigQuery jobs are recorded in it,
+					and a rerun reuses them instead of starting over
+				bq: optional BqImporter to use instead of logging in with key
+				table_lists: optional dict to share dataset listings with other runners through
+				discovery: optional DiscoveryCache to build the BigQuery service from
+				dry_run: only report the bytes the query would scan per dataset (and chunk), without running it
+				byte_budget: optional maximum number of bytes a single query job may scan
+				budget_action: 'refuse' to raise ByteBudgetExceeded for queries over byte_budget, 
+					or 'chunk' to split them into chunks of fewer days (see chunk_days) until each fits
+				result_cache: optional QueryResultCache; the query (and export) is skipped when the 
+					destination table still holds the result of the same query over unchanged source tables
+				direct_read_max_bytes: optional size in bytes up to which the result is not exported to 
+					Cloud Storage, leaving the caller to read it with BqImporter.read_table (see direct_read)
+				metrics: optional Metrics to record stage timings, API calls and job statistics in
 		'''
 		self.null_val = lambda x: None if str(x).upper()=='(NOT SET)' else x
 		self.startdt = startdt
 		self.enddt = enddt
-		self.dts = self.get_dates(startdt,enddt)
+		self.dts = set(self.get_dates(startdt,enddt))
+		self.dates = sorted([ datetime.date(datetime.strptime(d,'%Y-%m-%d')) for d in self.dts ])
 		self.destination_dataset = dataset 
 		self.destination_table = table
 		self.uris = uris
 		self._project_number = project_number
 		self._service_account_email = service_account_email
-		self.bq = BqImporter(self._service_account_email, self._project_number, key)
+		self.bq = bq or BqImporter(self._service_account_email, self._project_number, key, cache=table_cache, discovery=discovery, metrics=metrics)
 		self.dataset_keys = dataset_keys
 		self.table_schema = schema
-		self.table_match_re = table_match_re
+		self.table_match_re = compile_re(table_match_re)
 		self.template = template
 		self.final_step = final_step
 		self.drop_before = drop_before
+		self.discovery_concurrency = discovery_concurrency
+		self.table_name = table_name
+		self.probe_tables = probe_tables
+		if probe_tables and not table_name: raise ValueError('probe_tables requires a table_name format')
+		self.chunk_days = chunk_days
+		self.chunk_concurrency = chunk_concurrency
+		self.chunk_retries = chunk_retries
+		self.state = state
+		self.state_key = state_key or '{0}.{1}'.format(dataset,table)
+		self.pending_tables = []
+		self.checkpoint = checkpoint
+		self.table_lists = table_lists
+		self.dry_run = dry_run
+		self.byte_budget = byte_budget
+		if budget_action not in ('refuse','chunk'): raise ValueError('budget_action must be refuse or chunk')
+		self.budget_action = budget_action
+		self.result_cache = result_cache
+		self.result_key = '{0}.{1}'.format(dataset,table)
+		self.direct_read_max_bytes = direct_read_max_bytes
+		self.direct_read = False
 	
 	def _return_self(self):
 		return '''
@@ -77,45 +152,259 @@ class BigQueryRunner:
 	def __str__(self):
 		return self._return_self()
 	
-	def table_match(self,match_str, table_match_re):
+	def table_match(self,match_str, table_match_re=None, dts=None):
 		''' Returns True if table name matches naming convention and dates match dts argument 
 			Regex requires a 'datenum' group with YYYYMMDD-formatted date number
+			Uses the precompiled table_match_re and all dates in the range unless others are passed
 		'''
 		try:
-			d = match(table_match_re,match_str).group('datenum')
+			d = (compile_re(table_match_re) if table_match_re else self.table_match_re).match(match_str).group('datenum')
 		except:
 			return False
-		return d[:4]+'-'+d[4:6]+'-'+d[6:8] in self.dts
+		return d[:4]+'-'+d[4:6]+'-'+d[6:8] in (self.dts if dts is None else dts)
+	
+	def _map(self,fn,items):
+		''' Map fn over items with up to discovery_concurrency threads, keeping order '''
+		if self.discovery_concurrency<=1 or len(items)<=1:
+			return map(fn,items)
+		pool = ThreadPool(min(self.discovery_concurrency,len(items)))
+		try:
+			return pool.map(fn,items)
+		finally:
+			pool.close()
+			pool.join()
+	
+	def get_table_many(self,refs,warn_missing=True):
+		''' Fetch many (dataset, table) pairs in batch requests, spread over up to 
+			discovery_concurrency threads, returning the tables in order (None if missing) 
+		'''
+		batches = [ refs[i:i+BATCH_SIZE] for i in range(0,len(refs),BATCH_SIZE) ]
+		return sum(self._map(lambda b: self.bq.get_table_many(b,warn_missing),batches),[])
+	
+	def list_dataset_tables(self):
+		''' List the tables of every dataset in dataset_keys, fanning out across 
+			datasets with up to discovery_concurrency threads 
+			Returns a list of (dataset, tables) pairs ordered by dataset
+		'''
+		if self.probe_tables: listings = self.probe_dataset_tables()
+		else:
+			datasets = sorted(self.dataset_keys)
+			listings = zip(datasets,self._map(self.get_tables,datasets))
+		return self.filter_loaded(listings) if self.state is not None else listings
+	
+	def get_tables(self,dataset):
+		''' List the matching tables of a dataset, once per table_lists it is shared through '''
+		if self.table_lists is None: return self.bq.get_tables(dataset,self.table_match_re)
+		# Runners of other projects may share table_lists, with datasets of the same name
+		entry = self.table_lists.setdefault((self._project_number,dataset,self.table_match_re.pattern),{'lock': threading.Lock()})
+		with entry['lock']:
+			if 'tables' not in entry: entry['tables'] = self.bq.get_tables(dataset,self.table_match_re)
+		return entry['tables']
 	
-	def create_table_list(self):
+	def table_date(self,table):
+		''' Return the 'YYYY-MM-DD' date of a daily table name '''
+		d = self.table_match_re.match(table).group('datenum')
+		return d[:4]+'-'+d[4:6]+'-'+d[6:8]
+	
+	def filter_loaded(self,listings):
+		''' Keep only the days in the date range with a table that is new, or was modified since it was loaded 
+			Every table of such a day is kept, from all datasets, so the load can replace the whole day 
+			The kept tables are stored in pending_tables as (dataset, table, date, lastModifiedTime)
+		'''
+		matched = [ (d,t) for d,ts in listings for t in ts if self.table_match(t) ]
+		tables = self.get_table_many(matched)
+		loaded = self.state.get_loaded(self.state_key)
+		existing = [ (d,t,self.table_date(t),int(table.get('lastModifiedTime',0)))
+			for (d,t),table in zip(matched,tables) if table is not None ]
+		changed = [ (d,t,dt,m) for d,t,dt,m in existing if loaded.get((d,t))!=m ]
+		dates = set([ dt for _,_,dt,_ in changed ])
+		self.pending_tables = [ p for p in existing if p[2] in dates ]
+		logger.warning('{0} of {1} tables are new or changed since last loaded, processing {2} tables of {3} days'.format(
+			len(changed),len(matched),len(self.pending_tables),len(dates)))
+		pending = set([ (d,t) for d,t,_,_ in self.pending_tables ])
+		return [ (d,[ t for t in ts if (d,t) in pending ]) for d,ts in listings ]
+	
+	def pending_windows(self):
+		''' Return the pending table dates as a list of contiguous (first, last) date ranges '''
+		dates = sorted(set([ datetime.date(datetime.strptime(dt,'%Y-%m-%d')) for _,_,dt,_ in self.pending_tables ]))
+		windows = []
+		for d in dates:
+			if windows and (d-windows[-1][1]).days==1: windows[-1][1] = d
+			else: windows.append([d,d])
+		return [ (str(a),str(b)) for a,b in windows ]
+	
+	def probe_dataset_tables(self):
+		''' Build the table_name of every date in the range for every dataset and 
+			keep the ones that exist, without listing the datasets 
+			Returns a list of (dataset, tables) pairs ordered by dataset
+		'''
+		datasets = sorted(self.dataset_keys)
+		candidates = [ (d,self.table_name.format(dt)) for d in datasets for dt in self.dates ]
+		found = self.get_table_many(candidates,warn_missing=False)
+		existing = [ c for c,f in zip(candidates,found) if f ]
+		logger.warning('Found {0} of {1} candidate tables'.format(len(existing),len(candidates)))
+		return [ (d,[ t for e,t in existing if e==d ]) for d in datasets ]
+	
+	def create_table_list(self, listings=None, dts=None):
 		''' Create list of formatted, comma-separated tables to union within query statement 
 			Query for each table will be based on template string 
 			Tables will be based on the dts parameter 
 			Query template needs to match schema parameter 
 			Final query will select all fields from union'd tables
+			Optionally pass already fetched (dataset, tables) listings and a subset of dates
 		'''
+		listings = self.list_dataset_tables() if listings is None else listings
 		tables = ','.join([ m for m in 
 			map(lambda x: ','.join(filter((lambda z: len(z)>0),x)), [
 				map(
 					lambda x: self.template.format(d,x,self.dataset_keys[d])
-					,[z for z in t if self.table_match(z, self.table_match_re) ]
+					,sorted([z for z in t if self.table_match(z, dts=dts) ])
 				) 
-					for d,t in [ 
-						(d,self.bq.get_tables(d)) 
-						for d in self.dataset_keys 
-					] 
+					for d,t in listings
 				])
 			if len(m)>0 
 		])
 		return tables
 	
-	def exec_query_wait(self,query_str):
+	def submit_job(self,stage,submit):
+		''' Return the job id of a checkpointed stage, calling submit() for a new job id 
+			unless the checkpoint holds a job of that stage that is still running or succeeded 
+		'''
+		job = self.checkpoint.get(stage).get('job_id') if self.checkpoint else None
+		if job:
+			status = self.bq.get_jobinfo(job).get('status',{})
+			if status.get('errorResult'):
+				logger.warning('Checkpointed {0} job {1} failed, resubmitting'.format(stage,job))
+				job = None
+			else:
+				logger.warning('Reusing {0} job {1} ({2})'.format(stage,job,status.get('state','').lower()))
+		if not job:
+			job = submit()
+			if self.checkpoint: self.checkpoint.set(stage,job_id=job)
+		return job
+	
+	def exec_query_wait(self,query_str,stage='query',maximum_bytes_billed=None):
 		''' Execute query and wait for it to finish '''
-		import time
-		job = self.bq.query_to_table(query_str,self.destination_dataset,self.destination_table)
+		job = self.submit_job(stage,lambda: self.bq.query_to_table(query_str,self.destination_dataset,self.destination_table,maximum_bytes_billed=maximum_bytes_billed))
+		self.bq.jobs.track(job).result()
+		return True
+	
+	def chunk_dates(self):
+		''' Split the date range into consecutive sets of chunk_days date strings '''
+		dts = [ str(d) for d in self.dates ]
+		return [ set(dts[i:i+self.chunk_days]) for i in range(0,len(dts),self.chunk_days) ]
+	
+	def chunk_queries(self,listings):
+		''' Return the (YYYYMMDD of the first day, query) of every chunk of the date range that has tables '''
+		chunks = []
+		for dts in self.chunk_dates():
+			table_list = self.create_table_list(listings,dts)
+			if table_list: chunks.append((min(dts).replace('-',''),self.final_step.format(table_list)))
+		if not chunks: raise Exception('No tables found from {0} to {1}'.format(self.startdt,self.enddt))
+		return chunks
+	
+	def estimate(self,listings):
+		''' Dry run the query of every dataset, and of every chunk with chunk_days, and log the bytes they would scan 
+			Returns the bytes the whole query would scan
+		'''
+		queries = [ (d,self.final_step.format(tl)) for d,tl in [ (d,self.create_table_list([(d,ts)])) for d,ts in listings ] if tl ]
+		for (d,_),n in zip(queries,self._map(lambda dq: self.bq.dry_run_query(dq[1]),queries)):
+			logger.warning('Dataset {0} would scan {1}'.format(d,format_bytes(n)))
+		if self.chunk_days:
+			sizes = self.chunk_sizes(listings)
+			for c,n in sizes: logger.warning('Chunk {0} would scan {1}'.format(c,format_bytes(n)))
+			total = sum([ n for _,n in sizes ])
+		else:
+			total = self.bq.dry_run_query(self.final_step.format(self.create_table_list(listings)))
+		logger.warning('Query from {0} to {1} would scan {2}'.format(self.startdt,self.enddt,format_bytes(total)))
+		return total
+	
+	def chunk_sizes(self,listings):
+		''' Return the (chunk, bytes it would scan) of every chunk '''
+		chunks = self.chunk_queries(listings)
+		return zip([ c for c,_ in chunks ],self._map(lambda cq: self.bq.dry_run_query(cq[1]),chunks))
+	
+	def enforce_budget(self,listings):
+		''' Make sure no query job scans more than byte_budget bytes 
+			Queries over budget raise ByteBudgetExceeded, or with budget_action 'chunk' 
+			the date range is split into chunks of fewer days until every chunk fits 
+		'''
 		while True:
-			if self.bq.job_isfinished(job): break
-			time.sleep(5)
+			if self.chunk_days: sizes = self.chunk_sizes(listings)
+			else: sizes = [ ('query',self.bq.dry_run_query(self.final_step.format(self.create_table_list(listings)))) ]
+			largest = max([ n for _,n in sizes ])
+			if largest<=self.byte_budget:
+				logger.warning('Largest query would scan {0}, within the budget of {1}'.format(format_bytes(largest),format_bytes(self.byte_budget)))
+				return sizes
+			days = self.chunk_days or len(self.dates)
+			if self.budget_action!='chunk' or days==1:
+				raise ByteBudgetExceeded('{0} would scan {1}, over the budget of {2}'.format(
+					max(sizes,key=lambda s: s[1])[0],format_bytes(largest),format_bytes(self.byte_budget)))
+			self.chunk_days = max(1,min(days-1,int(days*self.byte_budget/largest)))
+			logger.warning('Query would scan {0}, over the budget of {1}; splitting into chunks of {2} days'.format(
+				format_bytes(largest),format_bytes(self.byte_budget),self.chunk_days))
+	
+	def exec_chunked_queries(self,listings=None):
+		''' Query each chunk of the date range into its own table, running up to 
+			chunk_concurrency jobs at once and resubmitting failed chunks, then 
+			union the chunk tables into the destination table 
+		'''
+		listings = self.list_dataset_tables() if listings is None else listings
+		chunks = self.chunk_queries(listings)
+		chunk_table = lambda c: '{0}_chunk_{1}'.format(self.destination_table,c)
+		pending, running, failed = list(chunks), 0, []
+		attempts = dict((c,0) for c,_ in chunks)
+		finished = Queue.Queue()
+		while pending or running:
+			while pending and running<self.chunk_concurrency:
+				c,q = pending.pop(0)
+				attempts[c] += 1
+				job = self.submit_job('chunk_'+c,lambda: self.bq.query_to_table(q,self.destination_dataset,chunk_table(c),maximum_bytes_billed=self.byte_budget))
+				self.bq.jobs.track(job,callback=lambda f,c=c,q=q: finished.put((c,q,f.exception())))
+				running += 1
+			c,q,error = finished.get()
+			running -= 1
+			if not error:
+				logger.warning('Chunk {0} finished'.format(c))
+			elif attempts[c]<=self.chunk_retries:
+				logger.warning('Chunk {0} failed ({1}), retrying'.format(c,error))
+				pending.append((c,q))
+			else:
+				logger.error('Chunk {0} failed: {1}'.format(c,error))
+				failed.append(c)
+		if failed: raise Exception('Chunks {0} failed, finished chunk tables were kept'.format(','.join(failed)))
+		union = ','.join([ '[{0}.{1}]'.format(self.destination_dataset,chunk_table(c)) for c,_ in chunks ])
+		self.exec_query_wait('SELECT * FROM {0}'.format(union),stage='union')
+		for c,_ in chunks: self.bq.drop_table(self.destination_dataset,chunk_table(c))
+		return True
+	
+	def fingerprint(self,listings):
+		''' Return a hash of the rendered query and the lastModifiedTime of every source table it reads '''
+		sources = sorted([ (d,t) for d,ts in listings for t in ts if self.table_match(t) ])
+		tables = self.get_table_many(sources)
+		h = sha256(self.final_step.format(self.create_table_list(listings)))
+		for (d,t),table in zip(sources,tables): h.update('\n{0}.{1}@{2}'.format(d,t,table.get('lastModifiedTime') if table else None))
+		return h.hexdigest()
+	
+	def cached_result(self,fingerprint):
+		''' Return the result cache entry if the destination table still holds the result with this fingerprint '''
+		entry = self.result_cache.get(self.result_key)
+		if not entry or entry['fingerprint']!=fingerprint: return None
+		table = self.bq.get_table(self.destination_dataset,self.destination_table,warn_missing=False)
+		if table is None or int(table.get('lastModifiedTime',0))!=entry['table_modified']: return None
+		return entry
+	
+	def record_result(self,fingerprint):
+		''' Record the result the destination table now holds '''
+		table = self.bq.get_table(self.destination_dataset,self.destination_table)
+		self.result_cache.put(self.result_key,fingerprint,int(table.get('lastModifiedTime',0)))
+	
+	def read_directly(self):
+		''' True if the result is small enough to read without an extract job '''
+		if self.direct_read_max_bytes is None: return False
+		num_bytes = int(self.bq.get_table(self.destination_dataset,self.destination_table).get('numBytes',0))
+		if num_bytes>self.direct_read_max_bytes: return False
+		logger.warning('Result is {0}, small enough to read directly'.format(format_bytes(num_bytes)))
 		return True
 	
 	def setup_table(self):
@@ -151,51 +440,194 @@ class BigQueryRunner:
 			Create table if necessary 
 			Create query, formatted based on template string 
 			Execute query and wait for query to finish 
+			Returns False if there was nothing new to process, or with dry_run
+			With a checkpoint, stages finished by an earlier run are skipped 
 		'''	
-		table_status = self.setup_table()
-		logger.warning('Table '+table_status.lower())
-		q = self.final_step.format(self.create_table_list())
-		logger.warning('Query created successfully')
-		logger.warning('Executing query from {0} to {1}...'.format(self.startdt,self.enddt))
-		successful = self.exec_query_wait(q)
+		cp = self.checkpoint
+		if cp and cp.done('listing'):
+			# Process exactly the tables the interrupted run was processing
+			listing = cp.get('listing')
+			listings = [ (d,ts) for d,ts in listing['listings'] ]
+			self.pending_tables = [ tuple(p) for p in listing['pending_tables'] ]
+		else:
+			with timed(self.bq.metrics,'listing',self.result_key): listings = self.list_dataset_tables()
+			if cp: cp.set('listing',done=True,listings=listings,pending_tables=self.pending_tables)
+		if self.state is not None and not self.pending_tables:
+			logger.warning('No new or changed tables from {0} to {1}'.format(self.startdt,self.enddt))
+			return False
+		if self.dry_run:
+			self.estimate(listings)
+			return False
+		# A dropped table has to be queried again whatever the cache says, and a checkpointed query is not run again anyway
+		fingerprint = self.fingerprint(listings) if self.result_cache and not self.drop_before and not (cp and cp.done('query')) else None
+		cached = self.cached_result(fingerprint) if fingerprint else None
+		if cp and cp.done('query'):
+			logger.warning('Query already finished, skipping to export')
+			successful = True
+		elif cached:
+			logger.warning('Table {0} already holds the result of this query over unchanged tables, skipping it'.format(self.result_key))
+			successful = True
+		else:
+			with timed(self.bq.metrics,'query',self.result_key):
+				if self.byte_budget: self.enforce_budget(listings)
+				# Leave the table alone while a checkpointed query job may still be writing it
+				if not (cp and (cp.get('query').get('job_id') or cp.get('union').get('job_id'))): logger.warning('Table '+self.setup_table().lower())
+				if self.chunk_days:
+					logger.warning('Executing query from {0} to {1} in chunks of {2} days...'.format(self.startdt,self.enddt,self.chunk_days))
+					successful = self.exec_chunked_queries(listings)
+				else:
+					q = self.final_step.format(self.create_table_list(listings))
+					logger.warning('Query created successfully')
+					logger.warning('Executing query from {0} to {1}...'.format(self.startdt,self.enddt))
+					successful = self.exec_query_wait(q,maximum_bytes_billed=self.byte_budget)
+				if fingerprint: self.record_result(fingerprint)
 		if successful: logger.warning('Query successful!')
-		logger.warning('Exporting data to cloud storage')
-		if len(self.uris)>0: 
-			job = self.bq.export_data_to_uris(
-				self.uris 
-				,self.destination_dataset
-				,self.destination_table
-				,compression='GZIP'
-				,destination_format='CSV'
-			)
-			job_resource = self.bq.wait_for_job(job,timeout=300)
+		if cp: cp.set('query',done=True)
+		# An export finished by an earlier run is downloaded, whatever the size
+		self.direct_read = not (cp and cp.done('extract')) and self.read_directly()
+		if cp and cp.done('extract'):
+			logger.warning('Data already exported to Cloud Storage at '+str(self.uris))
+		elif self.direct_read:
+			logger.warning('Skipping the export, the result is read from {0}'.format(self.result_key))
+		elif cached and cached['exported_uris']==self.uris:
+			logger.warning('Result already exported to Cloud Storage at '+str(self.uris))
+		elif len(self.uris)>0: 
+			with timed(self.bq.metrics,'export',self.result_key):
+				logger.warning('Exporting data to cloud storage')
+				job = self.submit_job('extract',lambda: self.bq.export_data_to_uris(
+					self.uris 
+					,self.destination_dataset
+					,self.destination_table
+					,compression='GZIP'
+					,destination_format='CSV'
+				)['jobReference']['jobId'])
+				job_resource = self.bq.wait_for_job(job,timeout=300)
+			if cp: cp.set('extract',done=True,uris=self.uris)
+			if fingerprint: self.result_cache.set_exported(self.result_key,self.uris)
 			logger.warning('Data exported to Cloud Storage at '+str(self.uris))
+		logger.warning('BigQuery connection stats: {0}'.format(self.bq.connection_stats()))
+		return True
 
-def main(parse_args,config):
-	''' Run big query process and load data into Vertica '''
-	
-	# Grab configuration elements
-	(options, args) = parse_args.parse_args()
-	config.read(options.config)
-	t = imp.load_source('query_template',config.get('BigQuery','template_file'))
+def get_option(config,section,option,default=None,type=str):
+	''' Read an optional config value, falling back to default when it is not set '''
+	if not config.has_option(section,option): return default
+	return type(config.get(section,option))
+
+def check_options(options,config):
+	''' Raise ValueError for combinations of options that cannot run, or would lose or duplicate data '''
+	if options.incremental and not get_option(config,'State','state_file'): raise ValueError('-n needs a [State] state_file in the config')
+	# Reprocessed days are loaded again: without replacing their partitions or deduping they would be duplicated
+	if options.incremental and options.vertica and not (options.partitions or options.incremental_dedupe): raise ValueError('-n with -v needs -P or -i')
+	# Truncating would empty the whole table, while -P only replaces the window's partitions
+	if options.truncate and options.partitions: raise ValueError('-t cannot be combined with -P')
+
+def shard_name(name,shard):
+	''' Insert a shard id before the extensions of a file or object name, i.e. data.csv.gz -> data-<shard>.csv.gz '''
+	head,tail = os.path.split(name)
+	parts = tail.split('.',1)
+	return os.path.join(head,'{0}-{1}{2}'.format(parts[0],shard,'.'+parts[1] if len(parts)>1 else ''))
+
+def table_cache_from_config(config):
+	''' Return the TableListCache set up in the [Cache] section, or None '''
+	TABLE_CACHE_FILE = get_option(config,'Cache','table_cache_file')
+	if not TABLE_CACHE_FILE: return None
+	return TableListCache(
+		TABLE_CACHE_FILE
+		,ttl=get_option(config,'Cache','table_cache_ttl',3600,int)
+		,full_ttl=get_option(config,'Cache','table_cache_full_ttl',7*24*3600,int)
+		,max_entries=get_option(config,'Cache','table_cache_max_entries',1000,int)
+	)
+
+def discovery_from_config(config):
+	''' Return the DiscoveryCache set up in the [Cache] section, with the API root of [Connection] '''
+	return DiscoveryCache(
+		get_option(config,'Cache','discovery_cache_dir')
+		,ttl=get_option(config,'Cache','discovery_cache_ttl',24*3600,int)
+		,offline=get_option(config,'Cache','discovery_offline',False,lambda v: v.lower() in ('1','true','yes','on'))
+		,root_url=get_option(config,'Connection','root_url')
+	)
+
+def load_template(path):
+	''' Load a query template file as a module named after its path, so different templates can be loaded side by side '''
+	return imp.load_source('query_template_'+md5(os.path.abspath(path)).hexdigest(),path)
+
+# Pipeline stages that can be limited to a number of concurrent runs
+STAGES = ('bigquery','download','load')
+
+def write_metrics(metrics,config):
+	''' Write a run report to the files set up in the [Metrics] section '''
+	REPORT_FILE = get_option(config,'Metrics','report_file')
+	PROMETHEUS_FILE = get_option(config,'Metrics','prometheus_file')
+	if REPORT_FILE: metrics.write_json(REPORT_FILE)
+	if PROMETHEUS_FILE: metrics.write_prometheus(PROMETHEUS_FILE)
+
+def run_pipeline(options,config,bq=None,gs=None,table_lists=None,limits=None,metrics=None):
+	''' Run one template over one date window: query and export in BigQuery, then 
+		download and load into Vertica 
+		Args:
+			options: parsed command-line options
+			config: RawConfigParser with the run's config file read
+			bq: optional BqImporter to reuse (one is created otherwise)
+			gs: optional GsDownloader to reuse (one is created otherwise)
+			table_lists: optional dict of dataset listings shared with other pipelines
+			limits: optional dict of a semaphore per stage in STAGES, shared with other pipelines
+			metrics: optional Metrics to record the run in (used by new clients only, shared ones keep their own)
+	'''
+	limits = limits or dict((stage,threading.Semaphore(1)) for stage in STAGES)
+	if options.startdt is None:
+		lookback = get_option(config,'State','incremental_lookback_days',7,int) if options.incremental else 1
+		options.startdt = str(datetime.date(datetime.now()-relativedelta(days=lookback)))
+	t = load_template(config.get('BigQuery','template_file'))
 	PROJECT_NUMBER = config.get('Connection','Project_Number')
 	SERVICE_ACCOUNT_EMAIL = config.get('Connection','Service_Account_Email')
 	GS_BUCKET = config.get('GoogleStorage','gs_bucket')
 	GS_OBJ = config.get('GoogleStorage','gs_dest_object')
+	DOWNLOAD_WORKERS = get_option(config,'GoogleStorage','download_workers',4,int)
 	DEST_FILE = config.get('Destination','destination_file')
 	VERTICA_TABLE = config.get('Destination','vertica_table')
+	COPY_PARALLELISM = get_option(config,'Destination','copy_parallelism',4,int)
+	DEDUPE_KEYS = get_option(config,'Destination','dedupe_keys',None,lambda v: [ k.strip() for k in v.split(',') ])
+	PARTITION_KEY_FORMAT = get_option(config,'Destination','partition_key_format','%Y-%m-%d')
 	BQ_TABLE = config.get('BigQuery','bq_table')
 	BQ_DATASET = config.get('BigQuery','bq_dataset')
-	KEY = file(config.get('Connection','Key_File')).read()
+	DISCOVERY_CONCURRENCY = get_option(config,'BigQuery','discovery_concurrency',8,int)
+	CHUNK_CONCURRENCY = get_option(config,'BigQuery','chunk_concurrency',4,int)
+	CHUNK_RETRIES = get_option(config,'BigQuery','chunk_retries',1,int)
+	BYTE_BUDGET = get_option(config,'BigQuery','byte_budget',None,int)
+	BUDGET_ACTION = get_option(config,'BigQuery','budget_action','refuse')
+	DIRECT_READ_MAX_BYTES = get_option(config,'BigQuery','direct_read_max_bytes',None,int)
+	KEY = file(config.get('Connection','Key_File')).read() if bq is None or gs is None else None
+	discovery = discovery_from_config(config) if bq is None or gs is None else None
+	RESULT_CACHE_FILE = get_option(config,'Cache','result_cache_file')
+	result_cache = QueryResultCache(RESULT_CACHE_FILE) if RESULT_CACHE_FILE else None
+	check_options(options,config)
+	STATE_FILE = get_option(config,'State','state_file')
+	state = LoadStateStore(STATE_FILE) if options.incremental else None
 	
-	logger.warning('Starting Big Query Runner process')
+	logger.warning('Starting Big Query Runner process for {0}.{1}'.format(BQ_DATASET,BQ_TABLE))
+	
+	# Sharded exports are written as <object>-<shard>.<ext> through a wildcard URI
+	EXPORT_OBJ = shard_name(GS_OBJ,'*') if options.sharded else GS_OBJ
+	
+	# Record finished stages so a rerun of the same job resumes where this one failed
+	CHECKPOINT_DIR = get_option(config,'State','checkpoint_dir')
+	checkpoint = Checkpoint.for_run(CHECKPOINT_DIR
+		,template=config.get('BigQuery','template_file')
+		,startdt=options.startdt
+		,enddt=options.enddt
+		,bq_table='{0}.{1}'.format(BQ_DATASET,BQ_TABLE)
+		,export='gs://{0}/{1}'.format(GS_BUCKET,EXPORT_OBJ)
+		,vertica_table=VERTICA_TABLE if options.vertica else None
+	) if CHECKPOINT_DIR and not options.dry_run else None
+	# Partial downloads are only continued if they belong to an export that already finished
+	resume_downloads = checkpoint is not None and checkpoint.done('extract')
 	
 	# Create a big query runner object and execute query
 	# Results will be stored temporarily in Google Cloud Storage
 	q = BigQueryRunner(
 		dataset=BQ_DATASET 
 		,table=BQ_TABLE
-		,uris=['gs://{0}/{1}'.format(GS_BUCKET,GS_OBJ)]
+		,uris=['gs://{0}/{1}'.format(GS_BUCKET,EXPORT_OBJ)]
 		,startdt=options.startdt
 		,enddt=options.enddt
 		,schema=t.SCHEMA
@@ -207,25 +639,112 @@ def main(parse_args,config):
 		,service_account_email=SERVICE_ACCOUNT_EMAIL
 		,key=KEY
 		,drop_before=options.drop
+		,discovery_concurrency=DISCOVERY_CONCURRENCY
+		,table_cache=table_cache_from_config(config) if bq is None else None
+		,table_name=getattr(t,'TABLE_NAME',None)
+		,probe_tables=options.probe
+		,chunk_days=options.chunk_days
+		,chunk_concurrency=CHUNK_CONCURRENCY
+		,chunk_retries=CHUNK_RETRIES
+		,state=state
+		,state_key='{0}.{1}:{2}'.format(BQ_DATASET,BQ_TABLE,VERTICA_TABLE)
+		,checkpoint=checkpoint
+		,bq=bq
+		,table_lists=table_lists
+		,discovery=discovery
+		,dry_run=options.dry_run
+		,byte_budget=BYTE_BUDGET
+		,budget_action=BUDGET_ACTION
+		,result_cache=result_cache
+		,direct_read_max_bytes=DIRECT_READ_MAX_BYTES if options.vertica else None
+		,metrics=metrics
 	)
-	q.run()
+	with limits['bigquery']: ran = q.run()
+	if not ran:
+		if checkpoint: checkpoint.clear()
+		logger.warning('Big Query Runner dry run completed' if options.dry_run else 'Big Query Runner process completed, nothing to load')
+		return
+	
+	# Vertica partition keys of the loaded window(s), for partition swaps
+	# Incremental runs only swap the days they actually reprocessed
+	windows = q.pending_windows() if state else [(options.startdt,options.enddt)]
+	PARTITION_WINDOW = [ [ datetime.strptime(d,'%Y-%m-%d').strftime(PARTITION_KEY_FORMAT) for d in w ] for w in windows ] if options.partitions else None
 	
 	if options.vertica:
-		# Download data to temporary flat-file destination 
-		# Remove data from Google Cloud Storage after download
-		x = GsDownloader(SERVICE_ACCOUNT_EMAIL, KEY)
-		x.download(GS_BUCKET, GS_OBJ, DEST_FILE)
-		x.delete_obj(GS_BUCKET, GS_OBJ)
+		x = gs or GsDownloader(SERVICE_ACCOUNT_EMAIL, KEY, discovery=discovery, metrics=metrics)
+		if checkpoint and checkpoint.done('download'):
+			objects, files = checkpoint.get('download')['objects'], checkpoint.get('download')['files']
+		elif q.direct_read:
+			# Small results are read from the table itself, there is nothing in Cloud Storage
+			objects, files = [], [DEST_FILE]
+		elif options.sharded:
+			prefix, suffix = EXPORT_OBJ.split('*')
+			# Only this export's shards, not other objects sharing the prefix (i.e. data-eu-000000000000.csv.gz for data.csv.gz)
+			shard_re = compile_re(escape(prefix)+r'\d+'+escape(suffix)+'$')
+			objects = [ o for o in x.list_objects(GS_BUCKET, prefix) if shard_re.match(o) ]
+			files = [ shard_name(DEST_FILE,o[len(prefix):].split('.')[0]) for o in objects ]
+		else:
+			objects, files = [GS_OBJ], [DEST_FILE]
+		# Files copied by a failed earlier run are recorded, so appending loads do not copy them twice
+		def file_loaded(f):
+			if checkpoint: checkpoint.set('load',files=checkpoint.get('load').get('files',[])+[f])
+		copy_runner = lambda f,truncate,dedupe: VerticaCopyRunner(VERTICA_TABLE, t.COPY_COLUMNS, f, skip=1, delimiter=',', terminator=None, truncate=truncate, dedupe=dedupe, parallelism=COPY_PARALLELISM, incremental_dedupe=options.incremental_dedupe, dedupe_keys=DEDUPE_KEYS, partition_window=PARTITION_WINDOW
+			,loaded_files=checkpoint.get('load').get('files') if checkpoint else None, on_file_loaded=file_loaded)
 		
-		# Copy data into Vertica
-		# columns = [ x['name'] for x in q.SCHEMA ]
-		c = VerticaCopyRunner(VERTICA_TABLE, t.COPY_COLUMNS, DEST_FILE, skip=1, delimiter=',', terminator=None, truncate=options.truncate, dedupe=options.dedupe)
-		c.run()
+		if checkpoint and checkpoint.done('load'):
+			logger.warning('Data already loaded into {0}'.format(VERTICA_TABLE))
+		elif options.stream:
+			# Pipe each object straight from Cloud Storage (or the table) into a COPY from stdin
+			if q.direct_read: writers = [ lambda fd: q.bq.download_table_to_fd(BQ_DATASET, BQ_TABLE, fd, readers=DOWNLOAD_WORKERS) ]
+			else: writers = [ (lambda fd,o=o: x.download_to_fd(GS_BUCKET, o, fd)) for o in objects ]
+			with limits['download'], limits['load'], timed(metrics,'stream',q.result_key): report = copy_runner(files,options.truncate,options.dedupe).run_stream(writers)
+			if metrics: metrics.record_load(report, q.result_key)
+		else:
+			# Download data to temporary flat-file destination 
+			if checkpoint and checkpoint.done('download'):
+				logger.warning('Already downloaded {0}'.format(','.join(files)))
+			else:
+				with limits['download'], timed(metrics,'download',q.result_key):
+					started = time()
+					if q.direct_read: q.bq.download_table(BQ_DATASET, BQ_TABLE, DEST_FILE, readers=DOWNLOAD_WORKERS)
+					elif options.sharded: x.download_many(GS_BUCKET, objects, files, workers=DOWNLOAD_WORKERS, resume=resume_downloads)
+					elif options.ranged: x.download_ranged(GS_BUCKET, GS_OBJ, DEST_FILE, workers=DOWNLOAD_WORKERS)
+					else: x.download(GS_BUCKET, GS_OBJ, DEST_FILE, resume=resume_downloads)
+					if metrics: metrics.record_transfer('table_read' if q.direct_read else 'download', sum([ os.path.getsize(f) for f in files ]), time()-started, q.result_key)
+				if checkpoint: checkpoint.set('download',done=True,objects=objects,files=files,bytes=[ os.path.getsize(f) for f in files ])
+			
+			# Copy data into Vertica
+			# columns = [ x['name'] for x in q.SCHEMA ]
+			with limits['load'], timed(metrics,'load',q.result_key): report = copy_runner(files,options.truncate,options.dedupe).run()
+			if metrics: metrics.record_load(report, q.result_key)
+		if checkpoint: checkpoint.set('load',done=True)
 		
-		# Remove file 
-		os.remove(DEST_FILE)
+		# Remove data from Google Cloud Storage and local files only once the load succeeded
+		for o in objects: x.delete_obj(GS_BUCKET, o)
+		if result_cache and objects: result_cache.set_exported(q.result_key, None)
+		for f in files: 
+			if os.path.exists(f): os.remove(f)
+	
+	if state: state.mark_loaded(q.state_key, q.pending_tables)
+	if checkpoint: checkpoint.clear()
 	
-	logger.warning('Big Query Runner process completed')
+	logger.warning('Big Query Runner process completed for {0}.{1}'.format(BQ_DATASET,BQ_TABLE))
+
+def main(parse_args,config):
+	''' Run big query process and load data into Vertica '''
+	
+	# Grab configuration elements
+	(options, args) = parse_args.parse_args()
+	config.read(options.config)
+	try:
+		check_options(options,config)
+	except ValueError as e:
+		parse_args.error(str(e))
+	metrics = Metrics(run={'config': options.config, 'startdt': options.startdt, 'enddt': options.enddt})
+	try:
+		run_pipeline(options,config,metrics=metrics)
+	finally:
+		write_metrics(metrics,config)
 
 def test_query(startdt,enddt):
 	''' Create a test_query object for testing 
@@ -1,32 +1,66 @@
 # from bigquery import get_client
-import httplib2
-from apiclient.discovery import build
 from oauth2client.client import SignedJwtAssertionCredentials
 from apiclient.errors import HttpError
+from apiclient.http import BatchHttpRequest
+from httpPool import AuthorizedHttpPool
+from discovery import DiscoveryCache
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
 from json import dumps
 from hashlib import sha256
-import logging
-from datetime import datetime
+import logging, re, random, threading, csv, gzip
+from datetime import datetime, timedelta
 from time import sleep,time
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# Rows requested per tabledata.list page
+PAGE_SIZE = 10000
+
+# Requests sent per multipart batch request
+BATCH_SIZE = 50
+
+# Retries of batched requests failing with a server error, backing off exponentially up to MAX_BACKOFF seconds
+NUM_RETRIES = 5
+MAX_BACKOFF = 64
+
+def _retryable(exception):
+	''' True for errors of a batched request worth sending again '''
+	return isinstance(exception, HttpError) and (int(exception.resp['status']) >= 500 or int(exception.resp['status']) == 429)
+
+def _csv_value(field_type):
+	''' Return a function formatting a tabledata.list value of a field type like an extract to CSV does '''
+	def timestamp(v):
+		ts = datetime.utcfromtimestamp(float(v))
+		return ts.strftime('%Y-%m-%d %H:%M:%S.%f UTC' if ts.microsecond else '%Y-%m-%d %H:%M:%S UTC')
+	convert = timestamp if field_type=='TIMESTAMP' else lambda v: v.encode('utf-8')
+	return lambda v: None if v is None else convert(v)
+
 class BqImporter:
-	def __init__(self, service_account_email, project_number, key):
-		''' Pass account email and project number to initialize '''
+	def __init__(self, service_account_email, project_number, key, cache=None, discovery=None, metrics=None, credentials=None):
+		''' Pass account email and project number to initialize 
+			Optionally pass a tableCache.TableListCache to persist table listings, 
+			a discovery.DiscoveryCache to build the service from, a 
+			metrics.Metrics to record API calls and finished jobs in, and 
+			oauth2client credentials to use instead of the service account's 
+			(i.e. for a local stub of the API)
+		'''
 		self._service_account_email = service_account_email
 		self._project_number = project_number
 		self._key = key
 		self._active_jobs = []
-		self._service = build('bigquery', 'v2')
+		self.metrics = metrics
+		self._service = (discovery or DiscoveryCache()).build('bigquery', 'v2', request_builder=metrics.request_builder() if metrics else None)
 		# self._client = get_client(self._project_number, service_account=self._service_account_email,
                     # private_key=self._key, readonly=True)
-		self._credentials = SignedJwtAssertionCredentials(
+		self._credentials = credentials or SignedJwtAssertionCredentials(
 			   self._service_account_email,
 			   self._key,
 			   scope='https://www.googleapis.com/auth/bigquery'
 	    )
-		self.cache = {}
+		self._http_pool = AuthorizedHttpPool(self._credentials)
+		self.cache = cache
+		self.jobs = JobManager(self)
 	
 	def _return_self(self):
 		''' Print string representation of settings '''
@@ -45,9 +79,12 @@ class BqImporter:
 		return self._return_self()
 	
 	def _authorize(self):
-		'''Authorize credentials'''
-		http = httplib2.Http()
-		return self._credentials.authorize(http)
+		'''Return this thread's pooled, authorized connection'''
+		return self._http_pool.get()
+	
+	def connection_stats(self):
+		''' Return counts of connections, handshakes and token refreshes so far '''
+		return self._http_pool.stats()
 	
 	def _check_jobs_active(self):
 		''' Check to see if jobs have not been cleared '''
@@ -102,7 +139,7 @@ class BqImporter:
 		results = response.get('datasets',[])
 		return [ '{0}'.format(d['datasetReference']['datasetId']) for d in results ]
 	
-	def get_table(self, dataset, table):
+	def get_table(self, dataset, table, warn_missing=True):
 		''' Retrieve a table if it exists '''
 		http = self._authorize()
 		try:
@@ -113,17 +150,104 @@ class BqImporter:
 			).execute(http=http)
 		except HttpError, e:
 			if int(e.resp['status']) == 404:
-				logging.warn('Table %s.%s does not exist', dataset, table)
+				if warn_missing: logging.warn('Table %s.%s does not exist', dataset, table)
 				return None
 			raise
 	
-	def check_table(self, dataset, table):
+	def check_table(self, dataset, table, warn_missing=True):
 		''' Check to see if a table exists '''
-		table = self.get_table(dataset, table)
+		table = self.get_table(dataset, table, warn_missing)
 		return bool(table)
 	
-	def get_tables(self, datasetId):
-		'''Print all table IDs for a given dataset
+	def _new_batch(self, callback):
+		''' Return an empty batch request to the BigQuery batch endpoint '''
+		new_batch = getattr(self._service, 'new_batch_http_request', None)
+		# apiclient before 1.6 only knows the global batch endpoint
+		return new_batch(callback=callback) if new_batch else BatchHttpRequest(callback=callback)
+	
+	def _execute_many(self, requests, batch_size=BATCH_SIZE):
+		''' Execute apiclient requests in multipart batch requests of up to batch_size 
+			Requests failing with a server error or rate limiting are sent again in 
+			a later batch, up to NUM_RETRIES times
+			Returns a (response, exception) pair per request, in order
+		'''
+		results = [None] * len(requests)
+		if not requests: return results
+		http = self._authorize()
+		def callback(request_id, response, exception):
+			results[int(request_id)] = (response, exception)
+		pending, retries = range(len(requests)), 0
+		while True:
+			for start in range(0, len(pending), batch_size):
+				batch = self._new_batch(callback)
+				for i in pending[start:start + batch_size]: batch.add(requests[i], request_id=str(i))
+				started = time()
+				batch.execute(http=http)
+				if self.metrics: self.metrics.record_call('bigquery.batch', time() - started)
+			pending = [ i for i in pending if _retryable(results[i][1]) ]
+			if not pending or retries >= NUM_RETRIES: return results
+			retries += 1
+			sleeptime = random.random() * min(MAX_BACKOFF, 2**retries)
+			logger.warning('{0} batched requests failed, retry #{1} in {2:.1f} seconds'.format(len(pending), retries, sleeptime))
+			sleep(sleeptime)
+	
+	def get_table_many(self, refs, warn_missing=True):
+		''' Retrieve many tables with batch requests 
+			Args:
+				refs: list of (dataset, table) pairs
+			Returns the table resources in the order of refs, None for tables that do not exist
+		'''
+		requests = [ self._service.tables().get(projectId=self._project_number, datasetId=d, tableId=t) for d,t in refs ]
+		tables = []
+		for (d,t),(table,e) in zip(refs, self._execute_many(requests)):
+			if e is not None:
+				if not isinstance(e, HttpError) or int(e.resp['status']) != 404: raise e
+				if warn_missing: logging.warn('Table %s.%s does not exist', d, t)
+			tables.append(table if e is None else None)
+		return tables
+	
+	def check_table_many(self, refs, warn_missing=True):
+		''' Check which of many (dataset, table) pairs exist with batch requests, returning booleans in order '''
+		return [ bool(t) for t in self.get_table_many(refs, warn_missing) ]
+	
+	def get_tables(self, datasetId, table_match_re=None):
+		'''Return all table IDs for a given dataset
+		Listings are served from the table cache when one is set. Once a cached 
+		listing expires, and table_match_re (with a 'datenum' group) is given, 
+		only tables dated after the newest cached one are looked up (a listing 
+		without any matching table is listed again in full)
+		'''
+		if self.cache is None: return self._list_tables(datasetId)
+		entry = self.cache.get(self._project_number, datasetId)
+		if entry is not None:
+			if self.cache.is_fresh(entry): return entry['tables']
+			# Without a matching table there is no date to look up newer tables from
+			if table_match_re and self.cache.can_refresh(entry) and any([ re.match(table_match_re, t) for t in entry['tables'] ]):
+				tables = entry['tables'] + self._find_newer_tables(datasetId, entry['tables'], table_match_re)
+				self.cache.put(self._project_number, datasetId, tables, listed_at=entry['listed_at'])
+				return tables
+		tables = self._list_tables(datasetId)
+		self.cache.put(self._project_number, datasetId, tables)
+		return tables
+	
+	def _find_newer_tables(self, datasetId, tables, table_match_re):
+		''' Look up daily tables dated after the newest match in tables, up to today '''
+		matches = [ m for m in [ re.match(table_match_re, t) for t in tables ] if m ]
+		if not matches: return []
+		latest = max(matches, key=lambda m: m.group('datenum'))
+		prefix = latest.string[:latest.start('datenum')]
+		suffix = latest.string[latest.end('datenum'):]
+		day = datetime.strptime(latest.group('datenum'), '%Y%m%d').date() + timedelta(days=1)
+		candidates = []
+		while day <= datetime.now().date():
+			candidates.append('{0}{1:%Y%m%d}{2}'.format(prefix, day, suffix))
+			day += timedelta(days=1)
+		found = [ t for t,f in zip(candidates, self.check_table_many([ (datasetId,t) for t in candidates ])) if f ]
+		logger.warning('Found {0} new tables in {1}'.format(len(found), datasetId))
+		return found
+	
+	def _list_tables(self, datasetId):
+		'''List all table IDs for a given dataset
 		Adapted from https://github.com/tylertreat/BigQuery-Python
 		'''
 		http = self._authorize()
@@ -138,9 +262,8 @@ class BqImporter:
 				pageToken=page_token
 			).execute(http=http)
 			page_token = res.get('nextPageToken')
-			result['tables'] += res.get('tables', [])
-		self.cache[datasetId] = (datetime.now(), result)
-		return [ '{0}'.format(t['tableReference']['tableId']) for t in result['tables'] ]
+			result['tables'] = result.get('tables', []) + res.get('tables', [])
+		return [ '{0}'.format(t['tableReference']['tableId']) for t in result.get('tables', []) ]
 	
 	def list_jobs(self):
 		http = self._authorize()
@@ -156,6 +279,23 @@ class BqImporter:
 			# jobs['jobs'] += res.get('jobs',[])
 		return jobs
 	
+	def list_unfinished_jobs(self):
+		''' Return the set of job ids that are pending or running, in one jobs.list sweep '''
+		http = self._authorize()
+		job_ids = set()
+		page_token = None
+		while True:
+			res = self._service.jobs().list(
+				projectId=self._project_number
+				,stateFilter=['pending','running']
+				,projection='minimal'
+				,maxResults=1000
+				,pageToken=page_token
+			).execute(http=http)
+			job_ids.update([ j['jobReference']['jobId'] for j in res.get('jobs',[]) ])
+			page_token = res.get('nextPageToken')
+			if not page_token: return job_ids
+	
 	def _raise_executing_exception_if_error(self, job):
 		''' Extract error message from job 
 			Adapted from https://github.com/tylertreat/BigQuery-Python
@@ -170,36 +310,16 @@ class BqImporter:
 			raise Exception(
 				"Reason:{reason}. Message:{message}".format(**error_result))
 	
-	def wait_for_job(self, job, interval=5, timeout=60):
+	def wait_for_job(self, job, interval=None, timeout=60):
 		''' Wait until the job is done or failed 
 			Adapted from https://github.com/tylertreat/BigQuery-Python
 			Args:
-				job: dict, representing a BigQuery job resource
-				interval: optional float polling interval in seconds, default = 5
+				job: dict, representing a BigQuery job resource, or a job id
+				interval: unused, polling is backed off by the job manager (self.jobs)
 				timeout: optional float timeout in seconds, default = 60
 		'''
-		http = self._authorize()
-		complete = False
-		job_id = job['jobReference']['jobId']
-		job_resource = None
-		
-		start_time = time()
-		elapsed_time = 0
-		while not (complete or elapsed_time > timeout):
-			sleep(interval)
-			request = self._service.jobs().get(projectId=self._project_number,
-				jobId=job_id)
-			job_resource = request.execute(http=http)
-			self._raise_executing_exception_if_error(job_resource)
-			complete = job_resource.get('status').get('state') == u'DONE'
-			elapsed_time = time() - start_time
-		
-		# raise exceptions if timeout
-		if not complete:
-			logging.error('BigQuery job %s timeout' % job_id)
-			raise BigQueryTimeoutException()
-		
-		return job_resource
+		job_id = job['jobReference']['jobId'] if isinstance(job, dict) else job
+		return self.jobs.track(job_id).result(timeout)
 	
 	def get_jobinfo(self,job_id):
 		http = self._authorize()
@@ -209,6 +329,32 @@ class BqImporter:
 		).execute(http=http)
 		return job
 	
+	def _get_jobinfo_many(self, job_ids):
+		''' Return a (resource, exception) pair per job, in order, with batch requests '''
+		requests = [ self._service.jobs().get(projectId=self._project_number, jobId=j) for j in job_ids ]
+		return self._execute_many(requests)
+	
+	def get_jobinfo_many(self, job_ids):
+		''' Return the resources of many jobs, in order, with batch requests (raising the first error) '''
+		results = self._get_jobinfo_many(job_ids)
+		for _,e in results:
+			if e is not None: raise e
+		return [ job for job,_ in results ]
+	
+	def job_isfinished_many(self, job_ids):
+		''' Check whether many query jobs are complete with batch requests, returning booleans in order '''
+		requests = [ self._service.jobs().getQueryResults(
+			projectId=self._project_number
+			,jobId=j
+			,startIndex=0
+			,maxResults=0
+			,timeoutMs=0
+		) for j in job_ids ]
+		results = self._execute_many(requests)
+		for _,e in results:
+			if e is not None: raise e
+		return [ r.get('jobComplete',False) for r,_ in results ]
+	
 	def create_table(self, datasetId, tableId, schema):
 		"""Create a new table in the dataset.
 		Adapted from https://github.com/tylertreat/BigQuery-Python
@@ -254,16 +400,23 @@ class BqImporter:
 		).execute(http=http)
 		return response
 	
-	def query_to_table(self, query, datasetId, tableId, allow_large_results=True, show_job=False):
-		""" Write query result to table. 
-		Adapted from https://github.com/tylertreat/BigQuery-Python
-		Args: 
-			query: required BigQuery query string.
-            dataset: required string id of the dataset
-            table: required string id of the table
-			allow_large_results: optional boolean
-		"""
+	def dry_run_query(self, query):
+		''' Dry run a query and return the number of bytes it would process, without running it '''
 		http = self._authorize()
+		body = {
+			'configuration': {
+				'query': {'query': query}
+				,'dryRun': True
+			}
+		}
+		job_resource = self._service.jobs().insert(
+				projectId=self._project_number
+				, body=body
+			).execute(http=http)
+		return int(job_resource['statistics']['totalBytesProcessed'])
+	
+	def _query_job(self, query, datasetId, tableId, allow_large_results=True, maximum_bytes_billed=None):
+		""" Return the body of a job writing a query result to a table (see query_to_table) """
 		configuration = {
             "query": query,
         }
@@ -276,11 +429,25 @@ class BqImporter:
 		configuration['writeDisposition'] = 'WRITE_TRUNCATE'
 		configuration['allowLargeResults'] = allow_large_results
 		configuration['priority'] = 'BATCH'
-		body = {
+		if maximum_bytes_billed: configuration['maximumBytesBilled'] = str(maximum_bytes_billed)
+		return {
             "configuration": {
                 'query': configuration
             }
         }
+	
+	def query_to_table(self, query, datasetId, tableId, allow_large_results=True, show_job=False, maximum_bytes_billed=None):
+		""" Write query result to table. 
+		Adapted from https://github.com/tylertreat/BigQuery-Python
+		Args: 
+			query: required BigQuery query string.
+            dataset: required string id of the dataset
+            table: required string id of the table
+			allow_large_results: optional boolean
+			maximum_bytes_billed: optional limit of bytes, BigQuery fails the job instead of scanning more
+		"""
+		http = self._authorize()
+		body = self._query_job(query, datasetId, tableId, allow_large_results, maximum_bytes_billed)
 		if show_job: logger.warning('Writing to table {0}.{1} with job {2}'.format(datasetId,tableId,body))
 		else: logger.warning('Writing to table {0}.{1}'.format(datasetId,tableId))
 		job_resource = self._service.jobs().insert(
@@ -300,43 +467,8 @@ class BqImporter:
 		"""
 		return sha256(":".join(uris) + str(time())).hexdigest()
 	
-	def export_data_to_uris(
-		self,
-		destination_uris,
-		dataset,
-		table,
-		job=None,
-		compression=None,
-		destination_format=None,
-		print_header=None,
-		field_delimiter=None,
-	):
-		"""
-		Export data from a BigQuery table to cloud storage.
-		Adapted from https://github.com/tylertreat/BigQuery-Python
-		Args:
-			destination_uris: required string or list of strings representing
-				the uris on cloud storage of the form:
-					gs://bucket/filename
-			dataset: required string id of the dataset
-			table: required string id of the table
-			job: optional string identifying the job (a unique jobid
-				is automatically generated if not provided)
-			compression: optional string
-				(one of the JOB_COMPRESSION_* constants)
-			destination_format: optional string
-				(one of the JOB_DESTINATION_FORMAT_* constants)
-			print_header: optional boolean
-			field_delimiter: optional string
-			Optional arguments with value None are determined by
-			BigQuery as described:
-			https://developers.google.com/bigquery/docs/reference/v2/jobs
-		Returns:
-			dict, a BigQuery job resource
-		Raises:
-			JobInsertException on http/auth failures or error in result
-		"""
-		http = self._authorize()
+	def _extract_job(self, destination_uris, dataset, table, job=None, compression=None, destination_format=None, print_header=None, field_delimiter=None):
+		""" Return the body of a job exporting a table to cloud storage (see export_data_to_uris) """
 		destination_uris = destination_uris \
 			if isinstance(destination_uris, list) else [destination_uris]
 		
@@ -375,9 +507,302 @@ class BqImporter:
 			}
 		}
 		
+		return body
+	
+	def export_data_to_uris(
+		self,
+		destination_uris,
+		dataset,
+		table,
+		job=None,
+		compression=None,
+		destination_format=None,
+		print_header=None,
+		field_delimiter=None,
+	):
+		"""
+		Export data from a BigQuery table to cloud storage.
+		Adapted from https://github.com/tylertreat/BigQuery-Python
+		Args:
+			destination_uris: required string or list of strings representing
+				the uris on cloud storage of the form:
+					gs://bucket/filename
+			dataset: required string id of the dataset
+			table: required string id of the table
+			job: optional string identifying the job (a unique jobid
+				is automatically generated if not provided)
+			compression: optional string
+				(one of the JOB_COMPRESSION_* constants)
+			destination_format: optional string
+				(one of the JOB_DESTINATION_FORMAT_* constants)
+			print_header: optional boolean
+			field_delimiter: optional string
+			Optional arguments with value None are determined by
+			BigQuery as described:
+			https://developers.google.com/bigquery/docs/reference/v2/jobs
+		Returns:
+			dict, a BigQuery job resource
+		Raises:
+			JobInsertException on http/auth failures or error in result
+		"""
+		http = self._authorize()
+		body = self._extract_job(destination_uris, dataset, table, job, compression, destination_format, print_header, field_delimiter)
+		job = body['jobReference']['jobId']
+		
 		logger.warning("Creating export job %s" % body)
 		job_resource = self._service.jobs().insert(
 			projectId=self._project_number
 			, body=body
 		).execute(http=http)
+		self._active_jobs.append(job)
 		return job_resource
+	
+	def read_table(self, datasetId, tableId, f, readers=4, page_size=PAGE_SIZE, header=True):
+		''' Write the rows of a table as CSV to the file-like object f, without an extract job 
+			The rows are split into one startIndex range per reader, and the readers 
+			page through their ranges with tabledata.list concurrently, each writing 
+			whole pages to f. Row order is not kept. Like an extract to CSV, nested 
+			and repeated fields are not supported.
+			Args:
+				readers: number of concurrent readers
+				page_size: rows requested per page
+				header: write a header line of the field names first
+			Returns the number of rows written
+		'''
+		table = self.get_table(datasetId, tableId)
+		fields = table['schema']['fields']
+		if [ c for c in fields if c['type'] in ('RECORD','STRUCT') or c.get('mode')=='REPEATED' ]:
+			raise ValueError('Table {0}.{1} has nested or repeated fields, which cannot be written as CSV'.format(datasetId,tableId))
+		converters = [ _csv_value(c['type']) for c in fields ]
+		num_rows = int(table['numRows'])
+		lock = threading.Lock()
+		if header: csv.writer(f, lineterminator='\n').writerow([ c['name'] for c in fields ])
+		
+		def reader(bounds):
+			start, end = bounds
+			http = self._authorize()
+			while start < end:
+				page = self._service.tabledata().list(
+					projectId=self._project_number
+					,datasetId=datasetId
+					,tableId=tableId
+					,startIndex=start
+					,maxResults=min(page_size, end - start)
+				).execute(http=http).get('rows', [])
+				if not page: raise Exception('No rows returned at index {0} of {1}.{2}'.format(start,datasetId,tableId))
+				buf = StringIO()
+				w = csv.writer(buf, lineterminator='\n')
+				for row in page: w.writerow([ c(cell['v']) for c,cell in zip(converters,row['f']) ])
+				with lock: f.write(buf.getvalue())
+				start += len(page)
+		
+		step = num_rows / readers + 1
+		ranges = [ (i, min(num_rows, i + step)) for i in range(0, num_rows, step) ]
+		logger.warning('Reading {0} rows of {1}.{2} with {3} readers'.format(num_rows,datasetId,tableId,len(ranges)))
+		if ranges:
+			pool = ThreadPool(len(ranges))
+			try:
+				pool.map(reader, ranges)
+			finally:
+				pool.close()
+				pool.join()
+		return num_rows
+	
+	def download_table(self, datasetId, tableId, destination, readers=4):
+		''' Write a table to a gzip CSV file with read_table, as an extract and download would '''
+		logger.warning('Downloading table {0}.{1} to file {2}'.format(datasetId,tableId,destination))
+		out = gzip.open(destination, 'wb')
+		try:
+			self.read_table(datasetId, tableId, out, readers)
+		finally:
+			out.close()
+		return destination
+	
+	def download_table_to_fd(self, datasetId, tableId, fd, readers=4):
+		''' Write a table as gzip CSV to a file-like object with read_table, i.e. a pipe into COPY '''
+		out = gzip.GzipFile(fileobj=fd, mode='wb')
+		try:
+			self.read_table(datasetId, tableId, out, readers)
+		except:
+			# Leave the gzip stream unterminated, so a COPY reading it cannot take the 
+			# partial rows for a whole file (detached, closing or collecting out writes nothing)
+			out.fileobj = None
+			raise
+		# only ends the gzip stream, fd stays open
+		out.close()
+
+class BigQueryTimeoutException(Exception):
+	''' Raised when a BigQuery job does not finish in time '''
+	pass
+
+class JobFuture:
+	''' Result of a tracked BigQuery job, set by the JobManager once the job is done '''
+	def __init__(self, job_id):
+		self.job_id = job_id
+		self._done = threading.Event()
+		self._lock = threading.Lock()
+		self._callbacks = []
+		self._job_resource = None
+		self._exception = None
+	
+	def __repr__(self):
+		return 'JobFuture({0}, done={1})'.format(self.job_id, self.done())
+	
+	def done(self):
+		return self._done.is_set()
+	
+	def result(self, timeout=None):
+		''' Wait for the job and return its resource, raising if it failed or timed out '''
+		exception = self.exception(timeout)
+		if exception: raise exception
+		return self._job_resource
+	
+	def exception(self, timeout=None):
+		''' Wait for the job and return the exception it failed with, if any '''
+		if not self._done.wait(timeout):
+			logger.error('BigQuery job %s timeout' % self.job_id)
+			raise BigQueryTimeoutException('BigQuery job {0} timeout'.format(self.job_id))
+		return self._exception
+	
+	def add_done_callback(self, fn):
+		''' Call fn(future) once the job is done (immediately if it already is) '''
+		with self._lock:
+			if not self.done():
+				self._callbacks.append(fn)
+				return
+		self._call(fn)
+	
+	def _call(self, fn):
+		try:
+			fn(self)
+		except Exception:
+			logger.exception('Callback for job {0} failed'.format(self.job_id))
+	
+	def _set(self, job_resource=None, exception=None):
+		with self._lock:
+			self._job_resource = job_resource
+			self._exception = exception
+			self._done.set()
+			callbacks, self._callbacks = self._callbacks, []
+		for fn in callbacks: self._call(fn)
+
+class JobManager:
+	''' Track many in-flight BigQuery jobs and poll them from one background thread 
+		Polling backs off exponentially (with jitter) from min_interval to max_interval 
+		while nothing finishes, and starts over at min_interval when a job is tracked. 
+		A job whose lookup fails max_errors times in a row fails with that error. 
+		With more than sweep_threshold jobs tracked, one 
+		jobs.list sweep of unfinished jobs replaces a jobs.get per job, and only jobs 
+		missing from the sweep are fetched, together in batch requests. Finished 
+		jobs are dropped from the importer's active jobs.
+	'''
+	def __init__(self, bq, min_interval=1, max_interval=30, backoff=2, sweep_threshold=3, max_errors=5):
+		self._bq = bq
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.backoff = backoff
+		self.sweep_threshold = sweep_threshold
+		self.max_errors = max_errors
+		self._futures = {}
+		self._errors = {}
+		self._tracked = False
+		self._wakeup = threading.Condition()
+		self._thread = None
+	
+	def _return_self(self):
+		return 'JobManager tracking {0} jobs'.format(len(self._futures))
+	
+	def __str__(self):
+		return self._return_self()
+	
+	def __repr__(self):
+		return self._return_self()
+	
+	def track(self, job_id, callback=None):
+		''' Start tracking a job id and return its JobFuture 
+			callback: optional function called with the future once the job is done
+		'''
+		with self._wakeup:
+			future = self._futures.get(job_id)
+			if future is None:
+				future = self._futures[job_id] = JobFuture(job_id)
+				self._tracked = True
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self._run, name='bq-job-manager')
+				self._thread.daemon = True
+				self._thread.start()
+			self._wakeup.notify()
+		if callback: future.add_done_callback(callback)
+		return future
+	
+	def track_active(self):
+		''' Track every job the importer has started and not yet seen finish '''
+		return [ self.track(job_id) for job_id in list(self._bq._active_jobs) ]
+	
+	def wait(self, futures, timeout=None):
+		''' Wait for all futures and return their job resources, raising on the first failure '''
+		deadline = time() + timeout if timeout is not None else None
+		return [ f.result(None if deadline is None else max(0, deadline - time())) for f in futures ]
+	
+	def _run(self):
+		interval = self.min_interval
+		while True:
+			with self._wakeup:
+				while not self._futures: self._wakeup.wait()
+			try:
+				finished = self._poll()
+			except Exception:
+				logger.exception('Polling BigQuery jobs failed')
+				finished = 0
+			with self._wakeup:
+				tracked, self._tracked = self._tracked, False
+				interval = self.min_interval if finished or tracked else min(interval * self.backoff, self.max_interval)
+				# a newly tracked job wakes the poller up early
+				self._wakeup.wait(random.uniform(interval / 2.0, interval))
+	
+	def _poll(self):
+		''' Check every tracked job once, returning how many finished '''
+		with self._wakeup:
+			job_ids = list(self._futures)
+		if len(job_ids) > self.sweep_threshold:
+			try:
+				unfinished = self._bq.list_unfinished_jobs()
+				job_ids = [ j for j in job_ids if j not in unfinished ]
+			except Exception:
+				# i.e. no bigquery.jobs.list permission: every job is fetched instead
+				logger.exception('Listing unfinished BigQuery jobs failed, fetching every job')
+		try:
+			results = self._bq._get_jobinfo_many(job_ids)
+		except Exception as e:
+			logger.exception('Polling BigQuery jobs failed')
+			results = [ (None, e) ] * len(job_ids)
+		finished = 0
+		for job_id, (job_resource, error) in zip(job_ids, results):
+			if error is not None:
+				self._errors[job_id] = self._errors.get(job_id, 0) + 1
+				# Only this job fails, on a client error (i.e. a stale or foreign job id) or after 
+				# max_errors failed lookups in a row; the others are still polled
+				if (isinstance(error, HttpError) and not _retryable(error)) or self._errors[job_id] >= self.max_errors:
+					logger.error('Looking up BigQuery job {0} failed: {1}'.format(job_id, error))
+					self._finish(job_id, None, error)
+					finished += 1
+				continue
+			self._errors.pop(job_id, None)
+			if job_resource.get('status', {}).get('state') != 'DONE': continue
+			try:
+				self._bq._raise_executing_exception_if_error(job_resource)
+				exception = None
+			except Exception as e:
+				exception = e
+			if self._bq.metrics: self._bq.metrics.record_job(job_resource)
+			self._finish(job_id, job_resource, exception)
+			finished += 1
+		return finished
+	
+	def _finish(self, job_id, job_resource, exception):
+		''' Stop tracking a job and resolve its future '''
+		with self._wakeup:
+			future = self._futures.pop(job_id)
+			if job_id in self._bq._active_jobs: self._bq._active_jobs.remove(job_id)
+		self._errors.pop(job_id, None)
+		future._set(job_resource, exception)
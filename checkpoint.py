@@ -0,0 +1,74 @@
+import os
+import threading
+import logging
+from json import dumps, loads
+from hashlib import sha256
+from time import time
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+class Checkpoint:
+	''' JSON record of the pipeline stages a run has completed
+		Each stage keeps a dict of whatever it needs to resume (job ids, URIs,
+		local files, byte counts) plus a 'done' flag. The file is rewritten
+		atomically after every change, so a crash never leaves it half written.
+	'''
+	def __init__(self, path, run=None):
+		''' Args:
+				path: JSON file to keep the checkpoint in (loaded if it exists)
+				run: optional dict describing the run, stored for reference
+		'''
+		self.path = path
+		self._lock = threading.Lock()
+		self._state = {'run': run, 'stages': {}}
+		if os.path.exists(path):
+			with open(path, 'r') as f: self._state = loads(f.read())
+			logger.warning('Resuming from checkpoint {0} (finished: {1})'.format(path, ','.join(self.finished()) or 'nothing'))
+
+	@classmethod
+	def for_run(cls, directory, **run):
+		''' Return the checkpoint of the run described by the keyword arguments, kept in directory '''
+		if not os.path.isdir(directory): os.makedirs(directory)
+		digest = sha256(dumps(run, sort_keys=True)).hexdigest()[:16]
+		return cls(os.path.join(directory, 'checkpoint-{0}.json'.format(digest)), run)
+
+	def _return_self(self):
+		return 'Checkpoint {0} (finished: {1})'.format(self.path, ','.join(self.finished()))
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _save(self):
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as f: f.write(dumps(self._state, indent=1, sort_keys=True))
+		os.rename(tmp, self.path)
+
+	def get(self, stage):
+		''' Return the recorded data of a stage (empty if it never started) '''
+		with self._lock:
+			return dict(self._state['stages'].get(stage, {}))
+
+	def set(self, stage, **data):
+		''' Merge data into a stage's record and save it '''
+		with self._lock:
+			record = self._state['stages'].setdefault(stage, {})
+			record.update(data)
+			record['updated_at'] = time()
+			self._save()
+
+	def done(self, stage):
+		''' True if the stage was marked done '''
+		return bool(self.get(stage).get('done'))
+
+	def finished(self):
+		''' Return the names of the finished stages '''
+		return sorted([ s for s, r in self._state['stages'].items() if r.get('done') ])
+
+	def clear(self):
+		''' Remove the checkpoint once the whole run has succeeded '''
+		with self._lock:
+			self._state['stages'] = {}
+			if os.path.exists(self.path): os.remove(self.path)
@@ -1,12 +1,14 @@
 
 from optparse import OptionParser
-import subprocess, imp, logging, sys
+import subprocess, imp, logging, sys, os, re, threading, Queue
+from time import time
 
 # Read command-line params 
 parser = OptionParser()
 parser.add_option('-t','--table',action='store',type='string',dest='table',help='Destination Table',metavar='schema.table')
 parser.add_option('-c','--columns',action='store',type='string',dest='columns',help='Comma-separated list of columns',metavar='Col1,Col2,Col3')
-parser.add_option('-f','--file',action='store',type='string',dest='file',help='File to read data from',metavar='/file/loc')
+parser.add_option('-f','--file',action='store',type='string',dest='file',help='File (or comma-separated files) to read data from',metavar='/file/loc')
+parser.add_option('-p','--parallelism',action='store',type='int',dest='parallelism',default=1,help='Number of files copied at once (default 1)',metavar='1')
 parser.add_option('-s','--skip',action='store',type='int',dest='skip',help='Lines to skip (default 0)',metavar='0')
 parser.add_option('-e','--enclosure',action='store',type='string',dest='enclosure',help='Enclosure (default ")',metavar='\'\\"\'')
 parser.add_option('-d','--delimiter',action='store',type='string',dest='delimiter',help='Delimiter (default ;)',metavar='\';\'')
@@ -14,6 +16,9 @@ parser.add_option('-x','--terminator',action='store',type='string',dest='termina
 parser.add_option('-g',action='store_true',dest='gzip',default=False,help='Read Gzip file')
 parser.add_option('-r',action='store_true',dest='truncate',default=False,help='Truncate table before copy statement')
 parser.add_option('-u',action='store_true',dest='dedupe',default=False,help='De-dupe data after copy')
+parser.add_option('-i',action='store_true',dest='incremental_dedupe',default=False,help='Load through a staging table and only insert rows not already in the table')
+parser.add_option('-w','--window',action='store',type='string',dest='partition_window',default=None,help='Replace only the partitions between these partition keys (inclusive)',metavar='2015-01-01,2015-01-31')
+parser.add_option('-k','--keys',action='store',type='string',dest='dedupe_keys',default=None,help='Comma-separated key columns for -i (default: all columns)',metavar='Col1,Col2')
 
 # Read global config file
 CONFIG_FILE = '../../global.context.properties'
@@ -24,21 +29,151 @@ CONFIG = {k: v for (k,v) in [ (z.split('=')[0],z.split('=')[1]) for z in propert
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+class StreamWriteError(Exception):
+	''' Raised when vsql stops reading the data streamed to its stdin '''
+	pass
+
+class _PipeWriter:
+	''' File-like wrapper around a vsql stdin pipe
+		Write errors are raised as StreamWriteError so downloaders do not mistake 
+		them for retryable IO errors and resend data that was partly written
+	'''
+	def __init__(self, pipe):
+		self._pipe = pipe
+		self.bytes_written = 0
+	
+	def write(self, data):
+		try:
+			self._pipe.write(data)
+		except (IOError, OSError) as e:
+			raise StreamWriteError('vsql stopped reading its input: {0}'.format(e))
+		self.bytes_written += len(data)
+	
+	def flush(self):
+		pass
+
+class RunningProcess:
+	''' A started shell command whose stdout and stderr are read by background threads 
+		Lines are logged as they arrive, so chatty output can never fill the pipe 
+		buffers, and waiting blocks on the process instead of polling it 
+		Standard output and error are kept apart, so only stdout is ever parsed 
+	'''
+	def __init__(self, cmd, name=None, stdin=False, on_exit=None):
+		''' Args:
+				cmd: shell command to run (not logged, it may hold credentials)
+				name: label for log lines and the result
+				stdin: boolean to open a pipe to the process's standard input
+				on_exit: optional function called with this process once it has exited
+		'''
+		self.name = name or 'process'
+		self.output = []
+		self.errors = []
+		self._on_exit = on_exit
+		self._result = None
+		self._started = time()
+		self._process = subprocess.Popen(cmd,stdin=subprocess.PIPE if stdin else None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True)
+		self.stdin = self._process.stdin
+		self._lock = threading.Lock()
+		self._readers = [ self._thread(self._read,self._process.stdout,self.output), self._thread(self._read,self._process.stderr,self.errors) ]
+		self._waiter = self._thread(self._wait)
+	
+	def _thread(self, target, *args):
+		t = threading.Thread(target=target,args=args,name=self.name)
+		t.daemon = True
+		t.start()
+		return t
+	
+	def _read(self, stream, lines):
+		for line in iter(stream.readline,''):
+			line = line.rstrip()
+			with self._lock: lines.append(line)
+			if line: logger.warning('[{0}] {1}'.format(self.name,line))
+		stream.close()
+	
+	def _wait(self):
+		returncode = self._process.wait()
+		for r in self._readers: r.join()
+		self._result = {
+			'name': self.name
+			,'returncode': returncode
+			,'elapsed': time()-self._started
+			,'output': '\n'.join(self.output)
+			,'errors': '\n'.join(self.errors)
+		}
+		logger.warning('[{0}] exited with status {1} after {2:.1f}s'.format(self.name,returncode,self._result['elapsed']))
+		if self._on_exit: self._on_exit(self)
+	
+	def wait(self):
+		''' Block until the process exits and return its name, returncode, elapsed seconds, output (stdout) and errors (stderr) '''
+		self._waiter.join()
+		return self._result
+	
+	def kill(self):
+		''' Kill the process, if it is still running '''
+		try:
+			self._process.kill()
+		except OSError:
+			pass
+
+class ProcessRunner:
+	''' Run shell commands, one or several at once, without busy-waiting '''
+	def start(self, cmd, name=None, stdin=False, on_exit=None):
+		''' Start cmd and return its RunningProcess '''
+		return RunningProcess(cmd,name,stdin,on_exit)
+	
+	def run(self, cmd, name=None):
+		''' Run cmd to completion and return its result '''
+		return self.start(cmd,name).wait()
+	
+	def run_many(self, commands, parallelism=None, on_result=None):
+		''' Run (name, cmd) pairs with up to parallelism running at once 
+			on_result: optional function called with the index and result of each command as it exits
+			Returns the results in the order of commands
+		'''
+		parallelism = parallelism or len(commands)
+		exited = Queue.Queue()
+		pending = list(enumerate(commands))
+		running = {}
+		results = [None]*len(commands)
+		while pending or running:
+			while pending and len(running)<parallelism:
+				i,(name,cmd) = pending.pop(0)
+				running[self.start(cmd,name,on_exit=exited.put)] = i
+			p = exited.get()
+			i = running.pop(p)
+			results[i] = p.wait()
+			if on_result: on_result(i,results[i])
+		return results
+
+# Row count printed by vsql after a COPY
+ROWS_LOADED_RE = re.compile(r'Rows Loaded\s*\n-+\s*\n\s*(\d+)')
+
 class VerticaCopyRunner:
 	''' Simple class to instantiate a VSQL string and copy a data file into Vertica '''
-	def __init__(self, table, columns, file, skip=0, enclosure = '\\"', delimiter = ';', terminator = '''E'\\r' ''', gzip=True, truncate=False, dedupe=False):
+	def __init__(self, table, columns, file, skip=0, enclosure = '\\"', delimiter = ';', terminator = '''E'\\r' ''', gzip=True, truncate=False, dedupe=False, parallelism=1, hosts=None, incremental_dedupe=False, dedupe_keys=None, partition_window=None, loaded_files=None, on_file_loaded=None):
 		''' Initialize configuration parameters 
 			Args:
 				table: name of destination table (must be pre-created)
 				columns: list of column strings or manual comma-separated column definitions
-				file: file to read data from 
+				file: file, or list of files, to read data from 
 				skip: (default 0) lines to skip 
 				enclosure: (default ") string enclosure 
 				delimiter: (default ;) file delimiter 
 				terminator: (default E'\\r') end of line terminator 
 				gzip: (default True) gzip compression on file
-				truncate: (default False) truncate table before running
+				truncate: (default False) truncate table before running (not with partition_window)
 				dedupe: (default False) run a de-dupe process after copy
+				parallelism: (default 1) number of files copied at once, each in its own vsql session
+				hosts: (default vdwh_Hosts, else vdwh_Server) list of cluster nodes the sessions are spread over round-robin
+				incremental_dedupe: (default False) copy into a staging table, then insert only the rows not already 
+					in the table, so the cost follows the size of the load rather than of the table
+				dedupe_keys: (default all columns) list of columns identifying a row for incremental_dedupe
+				partition_window: (default None) (min, max) partition keys, or a list of them; the data is copied 
+					into a staging table and swapped with those partitions of the table, so a rerun replaces only 
+					the days it loads (the table must be partitioned, and the data must fall inside the window)
+				loaded_files: (default None) files a failed earlier run already copied into the table, which are 
+					skipped when copying straight into it (loads through the staging table copy every file again)
+				on_file_loaded: (default None) function called with each file once its COPY has committed
 		'''
 		self._server = CONFIG.get('vdwh_Server')
 		self._login = CONFIG.get('vdwh_Login')
@@ -46,7 +181,11 @@ class VerticaCopyRunner:
 		self._db = CONFIG.get('vdwh_Database')
 		self.table = table 
 		self.columns = columns
-		self.file = file
+		self.files = file if isinstance(file,list) else [file]
+		self.file = self.files[0]
+		self.parallelism = parallelism
+		self.hosts = hosts or [ h.strip() for h in CONFIG.get('vdwh_Hosts','').split(',') if h.strip() ] or [self._server]
+		self._runner = ProcessRunner()
 		self.skip = skip
 		self.enclosure = enclosure
 		self.delimiter = delimiter
@@ -54,12 +193,23 @@ class VerticaCopyRunner:
 		self.gzip = ' GZIP' if gzip else ''
 		self.truncate = truncate
 		self.dedupe = dedupe
+		self.incremental_dedupe = incremental_dedupe
+		self.dedupe_keys = dedupe_keys
+		self.partition_window = partition_window
+		# Truncating would empty the whole table, while only the window's partitions are replaced
+		if truncate and partition_window: raise ValueError('truncate cannot be combined with partition_window')
+		self.partition_windows = ([partition_window] if isinstance(partition_window[0],basestring) else partition_window) if partition_window else []
+		self.stage_table = '{0}_stage'.format(table)
+		self.load_table = self.stage_table if incremental_dedupe or partition_window else table
+		# Each COPY commits on its own: appending a file again would duplicate its rows
+		self.loaded_files = set(loaded_files or []) if self.load_table==table and not truncate else set()
+		self.on_file_loaded = on_file_loaded
 	
 	def _return_self(self):
 		return '''
 			Destination table: {0}
 			Source file: {1}
-		'''.format(self.table,self.file)
+		'''.format(self.table,','.join(self.files))
 	
 	def __repr__(self):
 		return self._return_self()
@@ -67,47 +217,240 @@ class VerticaCopyRunner:
 	def __repr__(self):
 		return self._return_self()
 	
-	def create_vsql_statement(self):
-		return 'vsql -h{0} -d{1} -U{2} -w{3}'.format(self._server,self._db,self._login,self._pw)
+	def create_vsql_statement(self, host=None):
+		return 'vsql -h{0} -d{1} -U{2} -w{3}'.format(host or self._server,self._db,self._login,self._pw)
 	
-	def create_copy_statement(self):
-		''' Generate copy statement '''
+	def create_copy_statement(self, stdin=False, file=None, truncate=None):
+		''' Generate copy statement 
+			With stdin, data is read from vsql's standard input instead of the file 
+			(exceptions and rejected data are still written next to the file name)
+			Optionally pass one of several files, and whether to truncate first
+		'''
+		file = file or self.file
+		truncate = self.truncate if truncate is None else truncate
 		copy_statement = ''' {truncate}
 		COPY {table} (
 			{column_str}
 		) 
-		FROM LOCAL '{file}'{gzip} DIRECT SKIP {skip} EXCEPTIONS '{file}.exc' REJECTED DATA '{file}.rej' ENCLOSED BY '{enclosure}' DELIMITER '{delimiter}' {terminator} ;
+		FROM LOCAL {source}{gzip} DIRECT SKIP {skip} EXCEPTIONS '{file}.exc' REJECTED DATA '{file}.rej' ENCLOSED BY '{enclosure}' DELIMITER '{delimiter}' {terminator} ;
 		'''.format(
-			table = self.table 
+			table = self.load_table 
 			,column_str = ','.join(self.columns) if isinstance(self.columns,list) else self.columns
 			,skip = self.skip 
-			,file = self.file 
+			,file = file 
+			,source = 'STDIN' if stdin else "'{0}'".format(file)
 			,enclosure = self.enclosure
 			,delimiter = self.delimiter 
 			,terminator = self.terminator
 			,gzip = self.gzip
-			,truncate = 'TRUNCATE TABLE {0};'.format(self.table) if self.truncate else ''
+			,truncate = 'TRUNCATE TABLE {0};'.format(self.table) if truncate else ''
 		)
 		return copy_statement
 	
-	def execute_query(self, vsql, sql):
-		active = [subprocess.Popen(vsql+' -c \"{0}\"'.format(sql),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)]
-		while active:
-			for p in active:
-				if p.poll() is not None:
-					std = [ line.strip() for line in p.stdout ]
-					if std!='\n': logger.warning(std)
-					p.stdout.close()
-					active.remove(p)
+	def _command(self, vsql, sql):
+		# exec replaces the shell, so killing the process kills vsql itself
+		return 'exec '+vsql+' -c \"{0}\"'.format(sql)
+	
+	def _check(self, result):
+		if result['returncode']!=0: raise Exception('vsql {0} exited with status {1}'.format(result['name'],result['returncode']))
+		return result
+	
+	def execute_query(self, vsql, sql, name='vsql'):
+		''' Run sql with vsql and return its output, raising if vsql fails '''
+		return self._check(self._runner.run(self._command(vsql,sql),name))['output']
+	
+	def execute_queries(self, statements, parallelism=None, on_success=None):
+		''' Run (name, vsql, sql) statements concurrently, up to parallelism at once 
+			on_success: optional function called with the index of each statement that succeeded, as it exits
+			Returns each statement's name, returncode, elapsed seconds and output, raising if any failed
+		'''
+		notify = lambda i,r: on_success(i) if on_success and r['returncode']==0 else None
+		results = self._runner.run_many([ (name,self._command(vsql,sql)) for name,vsql,sql in statements ],parallelism,notify)
+		return [ self._check(r) for r in results ]
+	
+	def execute_stream(self, vsql, sql, writer):
+		''' Run sql with writer(fileobj) streaming data into vsql's stdin 
+			Returns the vsql result, with the number of bytes streamed as bytes_written
+		'''
+		p = self._runner.start(self._command(vsql,sql),'vsql stdin',stdin=True)
+		pipe = _PipeWriter(p.stdin)
+		try:
+			writer(pipe)
+		except:
+			# Closing stdin would let vsql commit the partial data; killing it aborts the COPY
+			p.kill()
+			raise
+		finally:
+			try:
+				p.stdin.close()
+			except (IOError, OSError):
+				pass
+			result = p.wait()
+		self._check(result)
+		result['bytes_written'] = pipe.bytes_written
+		return result
+	
+	def _copy_statement(self, i, file, truncate=None):
+		''' Build the (name, vsql, sql) statement copying one file through the i-th host (round-robin) '''
+		host = self.hosts[i % len(self.hosts)]
+		sql = self.create_copy_statement(file=file, truncate=truncate)
+		logger.warning('Copying {0} into Vertica on {1} with statement {2}'.format(file,host,sql))
+		return ('{0}@{1}'.format(os.path.basename(file),host),self.create_vsql_statement(host),sql)
+	
+	def _file_report(self, i, file, result):
+		loaded = ROWS_LOADED_RE.search(result['output'])
+		return {
+			'file': file
+			,'host': self.hosts[i % len(self.hosts)]
+			,'elapsed': result['elapsed']
+			,'rows_loaded': int(loaded.group(1)) if loaded else None
+			,'rows_rejected': self._count_lines(file+'.rej')
+		}
+	
+	def _count_lines(self, path):
+		if not os.path.exists(path): return 0
+		with open(path,'rb') as f: return sum(1 for _ in f)
+	
+	def _merge_files(self, paths, destination):
+		''' Concatenate the existing paths into destination, returning it if anything was written '''
+		paths = [ p for p in paths if os.path.exists(p) ]
+		if not paths: return None
+		with open(destination,'wb') as out:
+			for p in paths:
+				with open(p,'rb') as f: out.write(f.read())
+		return destination
+	
+	def report(self, results):
+		''' Aggregate per-file results into one report, merging rejected data and exceptions files '''
+		loaded = [ r['rows_loaded'] for r in results ]
+		base = os.path.join(os.path.dirname(self.file), self.table)
+		return {
+			'table': self.table
+			,'files': len(results)
+			,'rows_loaded': None if None in loaded else sum(loaded)
+			,'rows_rejected': sum([ r['rows_rejected'] for r in results ])
+			,'rejected_file': self._merge_files([ r['file']+'.rej' for r in results ], base+'.rej') if len(results)>1 else self.file+'.rej'
+			,'exceptions_file': self._merge_files([ r['file']+'.exc' for r in results ], base+'.exc') if len(results)>1 else self.file+'.exc'
+			,'per_file': results
+		}
+	
+	def pre_copy(self, vsql):
+		''' Run the steps that precede a copy, returning whether the copy itself still needs to truncate '''
+		if self.load_table==self.table: return self.truncate
+		if self.truncate: self.execute_query(vsql,'TRUNCATE TABLE {0};'.format(self.table))
+		logger.warning('Preparing staging table {0}'.format(self.stage_table))
+		self.execute_query(vsql,'''
+			CREATE TABLE IF NOT EXISTS {1} LIKE {0} INCLUDING PROJECTIONS;
+			TRUNCATE TABLE {1};
+		'''.format(self.table,self.stage_table))
+		return False
+	
+	def get_columns(self, vsql):
+		''' Return the column names of the destination table from the catalog '''
+		schema,table = self.table.split('.',1) if '.' in self.table else ('public',self.table)
+		output = self.execute_query(vsql+' -At','''
+			SELECT column_name FROM v_catalog.columns 
+			WHERE table_schema ILIKE '{0}' AND table_name ILIKE '{1}' ORDER BY ordinal_position;
+		'''.format(schema,table))
+		return [ c.strip() for c in output.splitlines() if c.strip() ]
+	
+	def create_merge_statement(self, keys):
+		''' Insert staged rows whose keys are not in the destination table yet, then empty the stage 
+			Keys are compared null-safe, with a hash of the keys to let Vertica hash-join the stage 
+			against only the key columns of the destination table
+		'''
+		return '''
+			INSERT /*+ DIRECT */ INTO {table} 
+			SELECT DISTINCT s.* FROM {stage} s 
+			WHERE NOT EXISTS (
+				SELECT 1 FROM {table} t 
+				WHERE HASH({t_keys})=HASH({s_keys}) AND {match}
+			);
+			COMMIT;
+			TRUNCATE TABLE {stage};
+		'''.format(
+			table = self.table
+			,stage = self.stage_table
+			,t_keys = ','.join([ 't.'+k for k in keys ])
+			,s_keys = ','.join([ 's.'+k for k in keys ])
+			,match = ' AND '.join([ 't.{0}<=>s.{0}'.format(k) for k in keys ])
+		)
+	
+	def create_swap_statement(self):
+		''' Swap the staged partitions in the window into the table, then empty the stage 
+			(which holds the replaced partitions after the swap) 
+		'''
+		swaps = ''.join([ '''
+			SELECT SWAP_PARTITIONS_BETWEEN_TABLES('{0}', '{1}', '{2}', '{3}');'''.format(self.stage_table,w[0],w[1],self.table) for w in self.partition_windows ])
+		return '''{0}
+			TRUNCATE TABLE {1};
+		'''.format(swaps,self.stage_table)
 	
 	def run(self):
+		''' Copy every file into Vertica, parallelism files at a time, and return a load report '''
 		logger.warning('Creating statement to copy into Vertica')
 		vsql = self.create_vsql_statement()
-		sql = self.create_copy_statement()
-		logger.warning('Copying into Vertica with statement {0}'.format(sql))
-		self.execute_query(vsql,sql)
-		logger.warning('Completed copy into Vertica')
-		if self.dedupe:
+		truncate = self.pre_copy(vsql)
+		files = self._files_to_load(self.files)
+		if len(files)==1:
+			statements = [self._copy_statement(0,files[0],truncate=truncate)]
+		else:
+			if truncate: self.execute_query(vsql,'TRUNCATE TABLE {0};'.format(self.table))
+			statements = [ self._copy_statement(i,f,truncate=False) for i,f in enumerate(files) ]
+		results = self.execute_queries(statements,self.parallelism,on_success=lambda i: self._loaded(files[i]))
+		report = self.report([ self._file_report(i,f,r) for i,(f,r) in enumerate(zip(files,results)) ])
+		logger.warning('Completed copy into Vertica: {0} files, {1} rows loaded, {2} rows rejected'.format(report['files'],report['rows_loaded'],report['rows_rejected']))
+		self.post_copy(vsql)
+		return report
+	
+	def run_stream(self, writer):
+		''' Copy into Vertica from a stream instead of a file, so loading overlaps 
+			with producing the data and no local file is needed 
+			Args:
+				writer: function called with a file-like object to write the (gzipped) data to,
+					or a list of them (one per file), each streamed through its own COPY
+			Returns a load report like run
+		'''
+		logger.warning('Creating statement to stream into Vertica')
+		vsql = self.create_vsql_statement()
+		truncate = self.pre_copy(vsql)
+		writers = writer if isinstance(writer,list) else [writer]
+		files = [ self.files[i % len(self.files)] for i in range(len(writers)) ]
+		pending = self._files_to_load(files)
+		reports = []
+		for i,(w,file) in enumerate(zip(writers,files)):
+			if file not in pending: continue
+			sql = self.create_copy_statement(stdin=True,file=file,truncate=truncate and i==0)
+			logger.warning('Streaming into Vertica with statement {0}'.format(sql))
+			result = self.execute_stream(vsql,sql,w)
+			self._loaded(file)
+			logger.warning('Completed streaming {0} bytes into Vertica'.format(result['bytes_written']))
+			reports.append(dict(self._file_report(0,file,result),bytes_written=result['bytes_written']))
+		report = self.report(reports)
+		self.post_copy(vsql)
+		return report
+	
+	def _files_to_load(self, files):
+		''' Return the files not loaded by an earlier run yet '''
+		skipped = [ f for f in files if f in self.loaded_files ]
+		if skipped: logger.warning('Skipping {0} files already loaded into {1}: {2}'.format(len(skipped),self.table,','.join(skipped)))
+		return [ f for f in files if f not in self.loaded_files ]
+	
+	def _loaded(self, file):
+		if self.on_file_loaded: self.on_file_loaded(file)
+	
+	def post_copy(self, vsql):
+		''' Run the steps that follow a copy '''
+		if self.partition_window:
+			logger.warning('Swapping partitions {0} from {1} into {2}'.format(','.join([ '{0} to {1}'.format(*w) for w in self.partition_windows ]),self.stage_table,self.table))
+			self.execute_query(vsql,self.create_swap_statement())
+			logger.warning('Partition swap finished')
+		elif self.incremental_dedupe:
+			keys = self.dedupe_keys or self.get_columns(vsql)
+			logger.warning('Merging new rows from {0} into {1} by {2}'.format(self.stage_table,self.table,','.join(keys)))
+			self.execute_query(vsql,self.create_merge_statement(keys))
+			logger.warning('Incremental dedupe finished')
+		elif self.dedupe:
 			logger.warning('Running dedupe process')
 			dedupe_sql = ''' 
 				DROP TABLE IF EXISTS X; 
@@ -121,8 +464,9 @@ class VerticaCopyRunner:
 
 def main(parser):
 	(options, args) = parser.parse_args()
+	if options.truncate and options.partition_window: parser.error('-r cannot be combined with -w')
 	try:
-		c = VerticaCopyRunner(options.table, options.columns.split(','), options.file, options.skip, options.enclosure, options.delimiter, options.terminator, options.gzip, options.truncate, options.dedupe)
+		c = VerticaCopyRunner(options.table, options.columns.split(','), options.file.split(','), options.skip, options.enclosure, options.delimiter, options.terminator, options.gzip, options.truncate, options.dedupe, options.parallelism, incremental_dedupe=options.incremental_dedupe, dedupe_keys=options.dedupe_keys.split(',') if options.dedupe_keys else None, partition_window=options.partition_window.split(',') if options.partition_window else None)
 	except Exception as e:
 		logger.error('Unable to parse arguments')
 		sys.exit(1)
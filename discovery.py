@@ -0,0 +1,102 @@
+from apiclient.discovery import build_from_document
+from apiclient.http import HttpRequest
+from json import dumps, loads
+from hashlib import sha256
+from time import time
+import httplib2, socket, os, threading
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Root of the Google APIs; discovery documents are served below it
+ROOT_URL = 'https://www.googleapis.com/'
+DISCOVERY_PATH = 'discovery/v1/apis/{api}/{version}/rest'
+
+class DiscoveryError(Exception):
+	pass
+
+class DiscoveryCache:
+	''' Cache of API discovery documents, so building a service does not fetch one
+		Documents are kept in memory for the life of the process and, with a path,
+		on disk for ttl seconds. An offline cache never fetches: it only builds
+		services from documents already on disk, whatever their age. With root_url
+		the documents are fetched from, and the services send requests to, that
+		root instead of the Google APIs, i.e. a local stub server.
+	'''
+	def __init__(self, path=None, ttl=24*3600, offline=False, root_url=None):
+		''' Args:
+				path: directory to keep documents in (created if necessary), None to only cache in memory
+				ttl: seconds a document on disk is used before it is fetched again
+				offline: never fetch documents, failing if one is not on disk
+				root_url: API root to use instead of https://www.googleapis.com/
+		'''
+		if offline and not path: raise ValueError('An offline discovery cache needs a path')
+		self.path = path
+		self.ttl = ttl
+		self.offline = offline
+		self.root_url = root_url.rstrip('/') + '/' if root_url else None
+		self._documents = {}
+		self._lock = threading.Lock()
+		if path and not os.path.isdir(path): os.makedirs(path)
+
+	def _return_self(self):
+		return 'Discovery cache: {0} (ttl {1}s{2}{3})'.format(self.path or 'in memory',self.ttl
+			,', offline' if self.offline else '',', root '+self.root_url if self.root_url else '')
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _file(self, api, version):
+		''' Documents of a stub root are kept apart from the real ones '''
+		root = '.'+sha256(self.root_url).hexdigest()[:8] if self.root_url else ''
+		return os.path.join(self.path, '{0}.{1}{2}.json'.format(api,version,root))
+
+	def _read(self, api, version):
+		''' Return (document, age in seconds) from disk, or (None, None) '''
+		if not self.path or not os.path.exists(self._file(api,version)): return None, None
+		with open(self._file(api,version), 'r') as f: document = f.read()
+		return document, time() - os.path.getmtime(self._file(api,version))
+
+	def _write(self, api, version, document):
+		tmp = self._file(api,version) + '.tmp'
+		with open(tmp, 'w') as f: f.write(document)
+		os.rename(tmp, self._file(api,version))
+
+	def _fetch(self, api, version):
+		url = (self.root_url or ROOT_URL) + DISCOVERY_PATH.format(api=api,version=version)
+		resp, content = httplib2.Http().request(url)
+		if resp.status != 200: raise DiscoveryError('Fetching {0} failed with status {1}'.format(url,resp.status))
+		loads(content)
+		return content
+
+	def document(self, api, version):
+		''' Return the discovery document of an API version as a JSON string '''
+		with self._lock:
+			if (api,version) in self._documents: return self._documents[(api,version)]
+			document, age = self._read(api,version)
+			if self.offline:
+				if document is None: raise DiscoveryError('No cached discovery document for {0} {1} in {2}'.format(api,version,self.path))
+			elif document is None or age >= self.ttl:
+				try:
+					document = self._fetch(api,version)
+					if self.path: self._write(api,version,document)
+				except (httplib2.HttpLib2Error, socket.error, ValueError, DiscoveryError) as e:
+					if document is None: raise
+					logger.warning('Using stale discovery document for {0} {1} ({2})'.format(api,version,e))
+			self._documents[(api,version)] = document
+			return document
+
+	def build(self, api, version, http=None, request_builder=None):
+		''' Build a service object like apiclient.discovery.build, from the cached document 
+			Optionally pass an HttpRequest subclass for the service to build its requests with
+		'''
+		document = self.document(api,version)
+		if self.root_url:
+			parsed = loads(document)
+			parsed['rootUrl'] = self.root_url
+			parsed['baseUrl'] = self.root_url + parsed.get('servicePath','')
+			document = dumps(parsed)
+		return build_from_document(document, http=http, requestBuilder=request_builder or HttpRequest)
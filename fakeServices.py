@@ -0,0 +1,571 @@
+import BaseHTTPServer, SocketServer
+from email.feedparser import FeedParser
+import urllib, urlparse
+import os, re, socket, stat, sys, threading
+from json import dumps, loads
+from hashlib import md5
+from base64 import b64encode
+from datetime import datetime, timedelta
+from time import time, sleep
+from uuid import uuid4
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Object content repeats this block, so objects of any size are served without storing them
+_PATTERN = os.urandom(1024 * 1024)
+
+# Tables referenced by a query, in legacy [dataset.table] or standard `dataset.table` form
+TABLE_REF_RE = re.compile(r'[\[`](?:[\w.:-]+[:.])?([\w-]+)\.([\w$-]+)[\]`]')
+
+def _param(location, type='string', required=False, repeated=False):
+	param = {'location': location, 'type': type}
+	if required: param['required'] = True
+	if repeated: param['repeated'] = True
+	return param
+
+def _method(method_id, path, http_method, params, request=None, response=None, media=False):
+	''' Describe one API method the way a discovery document does
+		params: dict of name to (location, type, required, repeated) arguments of _param
+	'''
+	method = {
+		'id': method_id
+		,'path': path
+		,'httpMethod': http_method
+		,'parameters': dict((name,_param(*p)) for name,p in params.items())
+		,'parameterOrder': re.findall(r'\{(\w+)\}', path)
+	}
+	if request: method['request'] = {'$ref': request}
+	if response: method['response'] = {'$ref': response}
+	if media: method['supportsMediaDownload'] = True
+	return method
+
+def _document(api, version, service_path, root_url, resources):
+	''' Return a minimal discovery document, with an empty object schema per $ref the methods use '''
+	refs = set([ m[k]['$ref'] for r in resources.values() for m in r.values() for k in ('request','response') if k in m ])
+	return {
+		'kind': 'discovery#restDescription'
+		,'discoveryVersion': 'v1'
+		,'id': '{0}:{1}'.format(api,version)
+		,'name': api
+		,'version': version
+		,'protocol': 'rest'
+		,'rootUrl': root_url
+		,'servicePath': service_path
+		,'baseUrl': root_url + service_path
+		,'batchPath': 'batch/{0}/{1}'.format(api,version)
+		,'parameters': {'fields': _param('query')}
+		,'resources': dict((name,{'methods': methods}) for name,methods in resources.items())
+		,'schemas': dict((ref,{'id': ref, 'type': 'object'}) for ref in refs)
+	}
+
+def bigquery_document(root_url):
+	''' Discovery document of the bigquery v2 methods the importer calls '''
+	project = {'projectId': ('path','string',True)}
+	dataset = dict(project, datasetId=('path','string',True))
+	table = dict(dataset, tableId=('path','string',True))
+	job = dict(project, jobId=('path','string',True))
+	page = {'maxResults': ('query','integer'), 'pageToken': ('query','string')}
+	return _document('bigquery', 'v2', 'bigquery/v2/', root_url, {
+		'datasets': {
+			'list': _method('bigquery.datasets.list','projects/{projectId}/datasets','GET',dict(project,**page),response='DatasetList')
+		}
+		,'tables': {
+			'list': _method('bigquery.tables.list','projects/{projectId}/datasets/{datasetId}/tables','GET',dict(dataset,**page),response='TableList')
+			,'get': _method('bigquery.tables.get','projects/{projectId}/datasets/{datasetId}/tables/{tableId}','GET',table,response='Table')
+			,'insert': _method('bigquery.tables.insert','projects/{projectId}/datasets/{datasetId}/tables','POST',dataset,request='Table',response='Table')
+			,'delete': _method('bigquery.tables.delete','projects/{projectId}/datasets/{datasetId}/tables/{tableId}','DELETE',table)
+		}
+		,'jobs': {
+			'insert': _method('bigquery.jobs.insert','projects/{projectId}/jobs','POST',project,request='Job',response='Job')
+			,'get': _method('bigquery.jobs.get','projects/{projectId}/jobs/{jobId}','GET',job,response='Job')
+			,'list': _method('bigquery.jobs.list','projects/{projectId}/jobs','GET',dict(project,stateFilter=('query','string',False,True),projection=('query','string'),allUsers=('query','boolean'),**page),response='JobList')
+			,'getQueryResults': _method('bigquery.jobs.getQueryResults','projects/{projectId}/queries/{jobId}','GET',dict(job,startIndex=('query','string'),timeoutMs=('query','integer'),**page),response='GetQueryResultsResponse')
+		}
+	})
+
+def storage_document(root_url):
+	''' Discovery document of the storage v1 methods the downloader calls '''
+	bucket = {'bucket': ('path','string',True)}
+	obj = dict(bucket, object=('path','string',True), generation=('query','string'))
+	return _document('storage', 'v1', 'storage/v1/', root_url, {
+		'objects': {
+			'get': _method('storage.objects.get','b/{bucket}/o/{object}','GET',obj,response='Object',media=True)
+			,'list': _method('storage.objects.list','b/{bucket}/o','GET',dict(bucket,prefix=('query','string'),maxResults=('query','integer'),pageToken=('query','string')),response='Objects')
+			,'delete': _method('storage.objects.delete','b/{bucket}/o/{object}','DELETE',obj)
+		}
+	})
+
+class _ApiError(Exception):
+	code, reason = 500, 'backendError'
+
+class _NotFound(_ApiError):
+	code, reason = 404, 'notFound'
+
+class _Conflict(_ApiError):
+	code, reason = 409, 'duplicate'
+
+def _error(code, reason, message):
+	return code, {'error': {'code': code, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+class FakeObject:
+	''' Cloud Storage object of any size, whose content is generated on the fly '''
+	def __init__(self, bucket, name, size, generation):
+		self.bucket = bucket
+		self.name = name
+		self.size = size
+		self.generation = generation
+		self._md5 = None
+
+	def read(self, start, end):
+		''' Yield the bytes from start up to end in blocks '''
+		while start < end:
+			offset = start % len(_PATTERN)
+			n = min(len(_PATTERN) - offset, end - start)
+			yield _PATTERN[offset:offset + n]
+			start += n
+
+	def md5(self):
+		''' Return the base64 MD5 of the content, computed once '''
+		if self._md5 is None:
+			digest = md5()
+			for block in self.read(0, self.size): digest.update(block)
+			self._md5 = b64encode(digest.digest())
+		return self._md5
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	# Clients may open hundreds of connections at once
+	request_queue_size = 1024
+
+	def __init__(self, *args):
+		BaseHTTPServer.HTTPServer.__init__(self, *args)
+		self.connections = {}
+		self._lock = threading.Lock()
+
+	def process_request(self, request, client_address):
+		''' Handle each connection in its own thread, remembered until the server is closed '''
+		thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+		thread.daemon = True
+		with self._lock: self.connections[request] = thread
+		thread.start()
+
+	def shutdown_request(self, request):
+		with self._lock: self.connections.pop(request, None)
+		BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+	def close_connections(self, timeout=5):
+		''' End the kept-alive connections and wait for their handler threads to exit '''
+		with self._lock: connections = self.connections.items()
+		for c,_ in connections:
+			try:
+				c.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		for _,thread in connections: thread.join(timeout)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# Keep connections alive, like the Google APIs do
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self._handle('GET')
+
+	def do_POST(self):
+		self._handle('POST')
+
+	def do_DELETE(self):
+		self._handle('DELETE')
+
+	def _handle(self, method):
+		parsed = urlparse.urlparse(self.path)
+		path = [ urllib.unquote(s) for s in parsed.path.strip('/').split('/') ]
+		query = urlparse.parse_qs(parsed.query, keep_blank_values=True)
+		length = int(self.headers.get('content-length') or 0)
+		body = self.rfile.read(length) if length else None
+		try:
+			response = self.server.google.handle(self, method, path, query, body)
+		except _ApiError as e:
+			response = _error(e.code, e.reason, str(e))
+		except Exception as e:
+			logger.exception('Fake request {0} {1} failed'.format(method, self.path))
+			response = _error(500, 'backendError', str(e))
+		if response is not None: self.send_json(*response)
+
+	def send_json(self, status, content=None):
+		data = dumps(content) if content is not None else ''
+		self.send_response(status)
+		if data: self.send_header('Content-Type', 'application/json; charset=UTF-8')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+class FakeGoogle:
+	''' Local stand-in for the bigquery v2 and storage v1 APIs, for benchmarks
+		Serves discovery documents for both APIs on a local port, so services built
+		by a discovery.DiscoveryCache with root_url=url call it instead of Google.
+		Datasets can hold thousands of generated tables, jobs finish job_seconds after
+		they are inserted (creating their destination table or exported objects), and
+		objects of any size are generated on the fly and support Range requests.
+		Authorization headers are not checked. Every API call is counted by method.
+	'''
+	def __init__(self, project='bench', job_seconds=5, latency=0, page_size=1000, result_rows=100000, export_bytes=64*1024*1024, export_shards=4):
+		''' Args:
+				project: project id the tables and jobs belong to
+				job_seconds: seconds from inserting a job until it is done
+				latency: seconds every API call waits before it is answered
+				page_size: default number of tables, jobs or objects per list page
+				result_rows: rows in the destination table of a query job
+				export_bytes: bytes exported by an extract job, split over export_shards objects for a wildcard URI
+		'''
+		self.project = project
+		self.job_seconds = job_seconds
+		self.latency = latency
+		self.page_size = page_size
+		self.result_rows = result_rows
+		self.export_bytes = export_bytes
+		self.export_shards = export_shards
+		self.datasets = {}
+		self.jobs = {}
+		self.objects = {}
+		self._calls = {}
+		self._lock = threading.Lock()
+		self._server = None
+		self._generation = int(time() * 1000000)
+
+	def _return_self(self):
+		return 'Fake Google APIs at {0}: {1} datasets, {2} jobs, {3} objects'.format(
+			self.url if self._server else '(stopped)', len(self.datasets), len(self.jobs), len(self.objects))
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:{0}/'.format(self._server.server_address[1])
+
+	def start(self):
+		''' Start serving on a free local port, returning self '''
+		self._server = _Server(('127.0.0.1', 0), _Handler)
+		self._server.google = self
+		thread = threading.Thread(target=self._server.serve_forever, name='fake-google')
+		thread.daemon = True
+		thread.start()
+		logger.warning('Started {0}'.format(self))
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+		self._server.close_connections()
+
+	def calls(self, reset=False):
+		''' Return the number of calls per API method so far, optionally starting over '''
+		with self._lock:
+			calls = dict(self._calls)
+			if reset: self._calls = {}
+		return calls
+
+	def _count(self, method):
+		with self._lock: self._calls[method] = self._calls.get(method, 0) + 1
+
+	def _next_generation(self):
+		with self._lock:
+			self._generation += 1
+			return self._generation
+
+	def add_table(self, dataset, table, rows=1000, nbytes=None, schema=None):
+		''' Create (or replace) a table '''
+		now = str(int(time() * 1000))
+		with self._lock:
+			self.datasets.setdefault(dataset, {})[table] = {
+				'kind': 'bigquery#table'
+				,'id': '{0}:{1}.{2}'.format(self.project, dataset, table)
+				,'tableReference': {'projectId': self.project, 'datasetId': dataset, 'tableId': table}
+				,'schema': {'fields': schema or []}
+				,'numRows': str(rows)
+				,'numBytes': str(nbytes if nbytes is not None else rows * 100)
+				,'creationTime': now
+				,'lastModifiedTime': now
+				,'type': 'TABLE'
+			}
+
+	def add_daily_tables(self, dataset, prefix, days, end=None, rows=1000, nbytes=None):
+		''' Create prefix+YYYYMMDD tables for the days up to end (default today), returning their names '''
+		end = end or datetime.now().date()
+		names = [ '{0}{1:%Y%m%d}'.format(prefix, end - timedelta(days=n)) for n in range(days) ]
+		for name in names: self.add_table(dataset, name, rows, nbytes)
+		return names
+
+	def add_object(self, bucket, name, size):
+		''' Create (or replace) an object of size bytes, returning it '''
+		obj = FakeObject(bucket, name, size, self._next_generation())
+		with self._lock: self.objects[(bucket, name)] = obj
+		return obj
+
+	def handle(self, request, method, path, query, body):
+		''' Answer one request with (status, JSON content), or None once the response was written '''
+		if path[:3] == ['discovery','v1','apis'] and len(path) == 6:
+			documents = {('bigquery','v2'): bigquery_document, ('storage','v1'): storage_document}
+			if tuple(path[3:5]) not in documents: raise _NotFound('No discovery document for {0} {1}'.format(*path[3:5]))
+			return 200, documents[tuple(path[3:5])](self.url)
+		if self.latency: sleep(self.latency)
+		if path[0] == 'batch' and method == 'POST': return self._batch(request, body)
+		return self._call(request, method, path, query, loads(body) if body else None)
+
+	def _call(self, request, method, path, query, body):
+		''' Answer one API call, on its own or as part of a batch '''
+		if path[:2] == ['bigquery','v2'] and len(path) > 3: return self._bigquery(method, path[4:], query, body)
+		if path[:3] == ['storage','v1','b']: return self._storage(request, method, path[3:], query)
+		if path[:4] == ['download','storage','v1','b']: return self._storage(request, method, path[4:], query)
+		raise _NotFound('Unknown path /{0}'.format('/'.join(path)))
+
+	def _batch(self, request, body):
+		''' Answer a multipart/mixed batch request, whose application/http parts are each one call '''
+		self._count('batch')
+		parser = FeedParser()
+		parser.feed('Content-Type: {0}\r\n\r\n'.format(request.headers.get('content-type')))
+		parser.feed(body)
+		boundary, parts = 'batch_{0}'.format(uuid4().hex), []
+		for part in parser.close().get_payload():
+			request_line, rest = part.get_payload().split('\n', 1)
+			method, url = request_line.split()[:2]
+			call = FeedParser()
+			call.feed(rest)
+			call_body = call.close().get_payload()
+			parsed = urlparse.urlparse(url)
+			try:
+				status, content = self._call(None, method, [ urllib.unquote(s) for s in parsed.path.strip('/').split('/') ]
+					,urlparse.parse_qs(parsed.query, keep_blank_values=True), loads(call_body) if call_body.strip() else None)
+			except _ApiError as e:
+				status, content = _error(e.code, e.reason, str(e))
+			data = dumps(content) if content is not None else ''
+			parts.append('--{0}\r\nContent-Type: application/http\r\nContent-ID: <response-{1}>\r\n\r\n'
+				'HTTP/1.1 {2} {3}\r\nContent-Type: application/json; charset=UTF-8\r\nContent-Length: {4}\r\n\r\n{5}\r\n'.format(
+				boundary, part['Content-ID'].strip('<>'), status, BaseHTTPServer.BaseHTTPRequestHandler.responses[status][0], len(data), data))
+		data = ''.join(parts) + '--{0}--\r\n'.format(boundary)
+		request.send_response(200)
+		request.send_header('Content-Type', 'multipart/mixed; boundary={0}'.format(boundary))
+		request.send_header('Content-Length', str(len(data)))
+		request.end_headers()
+		request.wfile.write(data)
+
+	def _page(self, items, query):
+		''' Return (page of items, next page token) for the pageToken and maxResults of a list call '''
+		start = int(query.get('pageToken', ['0'])[0] or 0)
+		end = start + int(query.get('maxResults', [self.page_size])[0] or self.page_size)
+		return items[start:end], str(end) if end < len(items) else None
+
+	def _list(self, key, items, token):
+		response = {key: items}
+		if token: response['nextPageToken'] = token
+		return response
+
+	def _bigquery(self, method, path, query, body):
+		resource = path[0] if path else None
+		if resource == 'datasets' and len(path) == 1:
+			self._count('bigquery.datasets.list')
+			with self._lock: datasets = sorted(self.datasets)
+			return 200, {'datasets': [ {'datasetReference': {'projectId': self.project, 'datasetId': d}} for d in datasets ]}
+		if resource == 'datasets' and len(path) >= 3 and path[2] == 'tables':
+			return self._tables(method, path[1], path[3] if len(path) > 3 else None, query, body)
+		if resource == 'jobs' and len(path) == 1 and method == 'POST':
+			self._count('bigquery.jobs.insert')
+			return 200, self._insert_job(body)
+		if resource == 'jobs' and len(path) == 1:
+			self._count('bigquery.jobs.list')
+			states = set([ s.upper() for s in query.get('stateFilter', []) ])
+			with self._lock:
+				jobs = [ self._job_resource(j) for _,j in sorted(self.jobs.items()) ]
+			jobs, token = self._page([ j for j in jobs if not states or j['status']['state'] in states ], query)
+			return 200, self._list('jobs', [ dict(j, state=j['status']['state']) for j in jobs ], token)
+		if resource in ('jobs','queries') and len(path) == 2:
+			self._count('bigquery.jobs.getQueryResults' if resource == 'queries' else 'bigquery.jobs.get')
+			with self._lock:
+				if path[1] not in self.jobs: raise _NotFound('Not found: Job {0}:{1}'.format(self.project, path[1]))
+				job = self._job_resource(self.jobs[path[1]])
+			if resource == 'jobs': return 200, job
+			return 200, {'kind': 'bigquery#getQueryResultsResponse', 'jobReference': job['jobReference'], 'jobComplete': job['status']['state'] == 'DONE'}
+		raise _NotFound('Unknown BigQuery path {0}'.format('/'.join(path)))
+
+	def _tables(self, method, dataset, table, query, body):
+		if table is None and method == 'POST':
+			self._count('bigquery.tables.insert')
+			reference = body['tableReference']
+			self.add_table(dataset, reference['tableId'], 0, 0, body.get('schema', {}).get('fields'))
+			with self._lock: return 200, self.datasets[dataset][reference['tableId']]
+		if table is None:
+			self._count('bigquery.tables.list')
+			with self._lock:
+				tables = self.datasets.get(dataset)
+				if tables is None: raise _NotFound('Not found: Dataset {0}:{1}'.format(self.project, dataset))
+				page, token = self._page(sorted(tables), query)
+				items = [ dict((k,tables[t][k]) for k in ('kind','id','tableReference','type','creationTime')) for t in page ]
+			return 200, dict(self._list('tables', items, token), totalItems=len(tables))
+		self._count('bigquery.tables.delete' if method == 'DELETE' else 'bigquery.tables.get')
+		with self._lock:
+			if table not in self.datasets.get(dataset, {}): raise _NotFound('Not found: Table {0}:{1}.{2}'.format(self.project, dataset, table))
+			if method == 'DELETE':
+				del self.datasets[dataset][table]
+				return 204, None
+			return 200, self.datasets[dataset][table]
+
+	def _insert_job(self, body):
+		configuration = body['configuration']
+		job_id = body.get('jobReference', {}).get('jobId') or 'job_{0}'.format(self._next_generation())
+		scanned = 0
+		if 'query' in configuration:
+			with self._lock:
+				scanned = sum([ int(self.datasets.get(d, {}).get(t, {}).get('numBytes', 0)) for d,t in TABLE_REF_RE.findall(configuration['query']['query']) ])
+		job = {
+			'id': job_id
+			,'configuration': configuration
+			,'created': time()
+			,'seconds': 0 if configuration.get('dryRun') else self.job_seconds
+			,'bytes': scanned
+			,'finished': False
+		}
+		with self._lock:
+			if job_id in self.jobs: raise _Conflict('Already Exists: Job {0}:{1}'.format(self.project, job_id))
+			self.jobs[job_id] = job
+			return self._job_resource(job)
+
+	def _job_resource(self, job):
+		''' Return the job resource in its current state, finishing the job once its time is up (call with the lock held) '''
+		elapsed = time() - job['created']
+		state = 'DONE' if elapsed >= job['seconds'] else 'RUNNING' if elapsed >= job['seconds'] / 10.0 else 'PENDING'
+		if state == 'DONE' and not job['finished']: self._finish(job)
+		created = int(job['created'] * 1000)
+		statistics = {'creationTime': str(created), 'totalBytesProcessed': str(job['bytes'])}
+		if state != 'PENDING': statistics['startTime'] = str(created + int(job['seconds'] * 100))
+		if state == 'DONE': statistics['endTime'] = str(created + int(job['seconds'] * 1000))
+		if 'query' in job['configuration']:
+			statistics['query'] = {'totalBytesProcessed': str(job['bytes']), 'totalBytesBilled': str(job['bytes']), 'totalSlotMs': str(int(job['seconds'] * 1000)), 'cacheHit': False}
+		return {
+			'kind': 'bigquery#job'
+			,'id': '{0}:{1}'.format(self.project, job['id'])
+			,'jobReference': {'projectId': self.project, 'jobId': job['id']}
+			,'configuration': job['configuration']
+			,'status': {'state': state}
+			,'statistics': statistics
+		}
+
+	def _finish(self, job):
+		''' Apply the effect of a job that just finished (call with the lock held) '''
+		job['finished'] = True
+		configuration = job['configuration']
+		now = str(int(time() * 1000))
+		if 'query' in configuration and not configuration.get('dryRun') and 'destinationTable' in configuration['query']:
+			reference = configuration['query']['destinationTable']
+			tables = self.datasets.setdefault(reference['datasetId'], {})
+			table = tables.get(reference['tableId']) or {
+				'kind': 'bigquery#table'
+				,'id': '{0}:{1}.{2}'.format(self.project, reference['datasetId'], reference['tableId'])
+				,'tableReference': {'projectId': self.project, 'datasetId': reference['datasetId'], 'tableId': reference['tableId']}
+				,'schema': {'fields': []}
+				,'creationTime': now
+				,'type': 'TABLE'
+			}
+			table.update({'numRows': str(self.result_rows), 'numBytes': str(self.result_rows * 100), 'lastModifiedTime': now})
+			tables[reference['tableId']] = table
+		if 'extract' in configuration:
+			for uri in configuration['extract']['destinationUris']:
+				bucket, name = uri[len('gs://'):].split('/', 1)
+				names = [ name.replace('*', '{0:012d}'.format(n)) for n in range(self.export_shards) ] if '*' in name else [name]
+				for n in names:
+					self._generation += 1
+					self.objects[(bucket, n)] = FakeObject(bucket, n, self.export_bytes / len(names), self._generation)
+
+	def _object_resource(self, obj):
+		link = '{0}download/storage/v1/b/{1}/o/{2}?generation={3}&alt=media'.format(self.url, obj.bucket, urllib.quote(obj.name, safe=''), obj.generation)
+		return {
+			'kind': 'storage#object'
+			,'bucket': obj.bucket
+			,'name': obj.name
+			,'size': str(obj.size)
+			,'generation': str(obj.generation)
+			,'md5Hash': obj.md5()
+			,'mediaLink': link
+		}
+
+	def _storage(self, request, method, path, query):
+		bucket = path[0]
+		if len(path) == 2:
+			self._count('storage.objects.list')
+			prefix = query.get('prefix', [''])[0]
+			with self._lock:
+				names = sorted([ n for b,n in self.objects if b == bucket and n.startswith(prefix) ])
+			names, token = self._page(names, query)
+			return 200, self._list('items', [ {'kind': 'storage#object', 'bucket': bucket, 'name': n} for n in names ], token)
+		with self._lock: obj = self.objects.get((bucket, path[2]))
+		generation = query.get('generation', [None])[0]
+		if obj is None or (generation and generation != str(obj.generation)):
+			raise _NotFound('No such object: {0}/{1}'.format(bucket, path[2]))
+		if method == 'DELETE':
+			self._count('storage.objects.delete')
+			with self._lock: del self.objects[(bucket, obj.name)]
+			return 204, None
+		if query.get('alt', [None])[0] != 'media':
+			self._count('storage.objects.get')
+			return 200, self._object_resource(obj)
+		self._count('storage.objects.get_media')
+		self._send_media(request, obj)
+
+	def _send_media(self, request, obj):
+		''' Write the object, or the part of it in the Range header, to the response '''
+		start, end, status = 0, obj.size - 1, 200
+		match = re.match(r'bytes=(\d+)-(\d*)$', (request.headers.get('range') or '').strip())
+		if match:
+			start, status = int(match.group(1)), 206
+			if match.group(2): end = min(end, int(match.group(2)))
+			if start >= obj.size:
+				request.send_response(416)
+				request.send_header('Content-Range', 'bytes */{0}'.format(obj.size))
+				request.send_header('Content-Length', '0')
+				request.end_headers()
+				return
+		request.send_response(status)
+		request.send_header('Content-Type', 'application/octet-stream')
+		request.send_header('Content-Length', str(end - start + 1))
+		if status == 206: request.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, obj.size))
+		request.end_headers()
+		for block in obj.read(start, end + 1): request.wfile.write(block)
+
+# Stand-in for vsql: prints the "Rows Loaded" table of a COPY after reading all of its
+# input (a LOCAL file or STDIN, gunzipped with GZIP), and succeeds for any other statement
+FAKE_VSQL = r"""#!{python}
+import sys, re, zlib
+args = sys.argv[1:]
+sql = args[args.index('-c') + 1] if '-c' in args else sys.stdin.read()
+copy = re.search(r"FROM LOCAL (STDIN|'([^']*)')( GZIP)?.*?SKIP (\d+)", sql, re.S)
+if copy is None: sys.exit(0)
+source = sys.stdin if copy.group(1) == 'STDIN' else open(copy.group(2), 'rb')
+lines, inflate = 0, zlib.decompressobj(16 + zlib.MAX_WBITS) if copy.group(3) else None
+for block in iter(lambda: source.read(1024 * 1024), ''):
+	while inflate is not None and block:
+		data = inflate.decompress(block)
+		lines += data.count('\n')
+		# concatenated gzip members start over
+		block = inflate.unused_data
+		if block: inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	if inflate is None: lines += block.count('\n')
+print ' Rows Loaded '
+print '-------------'
+print '{{0:>12}}'.format(max(0, lines - int(copy.group(4))))
+print '(1 row)'
+"""
+
+def write_fake_vsql(directory):
+	''' Write an executable fake vsql into directory, returning its path
+		Put the directory first on PATH for VerticaCopyRunner to run it
+	'''
+	path = os.path.join(directory, 'vsql')
+	with open(path, 'w') as f: f.write(FAKE_VSQL.format(python=sys.executable))
+	os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+	return path
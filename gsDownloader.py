@@ -1,97 +1,309 @@
 import httplib2
-from apiclient.discovery import build
-from apiclient.http import MediaIoBaseDownload
 from apiclient.errors import HttpError
 from oauth2client.client import SignedJwtAssertionCredentials
-from json import dumps
-from hashlib import sha256
-import logging
+from httpPool import AuthorizedHttpPool
+from discovery import DiscoveryCache
+from multiprocessing.pool import ThreadPool
+from json import dumps, loads
+from hashlib import sha256, md5
+from base64 import b64encode
+import logging, threading, random, time, os
 from datetime import datetime
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# crcmod is optional; without it downloads are verified against the MD5 hash,
+# which composite objects do not have
+try:
+	import crcmod.predefined
+except ImportError:
+	crcmod = None
+
 # Retry transport and file IO errors.
 RETRYABLE_ERRORS = (httplib2.HttpLib2Error, IOError)
 
 # Download chunk size 
 CHUNKSIZE = 2 * 1024 * 1024
 
+# Ranged downloads grow or shrink each worker's range size between these bounds,
+# aiming for one request every RANGE_TARGET_SECONDS
+MAX_RANGE_SIZE = 64 * 1024 * 1024
+RANGE_TARGET_SECONDS = 2.0
+
+# Retries of a failed chunk or range request, backing off exponentially up to MAX_BACKOFF seconds
+NUM_RETRIES = 5
+MAX_BACKOFF = 64
+
+# Size of the blocks read back when checksumming a downloaded file
+HASH_BLOCKSIZE = 1024 * 1024
+
+class ChecksumMismatchError(IOError):
+	pass
+
 class GsDownloader:
-	def __init__(self, service_account_email, key):
-		''' Pass account email and project number to initialize '''
+	def __init__(self, service_account_email, key, discovery=None, metrics=None, credentials=None):
+		''' Pass account email and project number to initialize 
+			Optionally pass a discovery.DiscoveryCache to build services from, 
+			a metrics.Metrics to record API calls in, and oauth2client 
+			credentials to use instead of the service account's
+		'''
 		self._service_account_email = service_account_email
 		self._key = key
 		self._active_jobs = []
-		self._credentials = SignedJwtAssertionCredentials(
+		self._credentials = credentials or SignedJwtAssertionCredentials(
 			   self._service_account_email,
 			   self._key,
 			   scope='https://www.googleapis.com/auth/devstorage.read_write'
 	    )
-		self._service = build('storage', 'v1')
+		self._http_pool = AuthorizedHttpPool(self._credentials)
+		self._local = threading.local()
+		self._discovery = discovery or DiscoveryCache()
+		self._request_builder = metrics.request_builder() if metrics else None
 	
 	def _authenticate_service(self):
-		''' Authorize credentials '''
-		http = self._credentials.authorize(httplib2.Http())
-		self._service = build('storage', 'v1', http=http)
+		''' Return a storage service bound to this thread's authorized connection '''
+		service = getattr(self._local, 'service', None)
+		if service is None:
+			service = self._local.service = self._discovery.build('storage', 'v1', http=self._http_pool.get(), request_builder=self._request_builder)
+		return service
 	
 	def _authorize(self):
-		'''Authorize credentials'''
-		http = httplib2.Http()
-		return self._credentials.authorize(http)
+		'''Return this thread's pooled, authorized connection'''
+		return self._http_pool.get()
 	
-	def handle_progressless_iter(error, progressless_iters):
+	def handle_progressless_iter(self, error, progressless_iters):
 		''' Progressess iteration function 
+			Raises error after NUM_RETRIES consecutive failures, otherwise sleeps a 
+			random time of up to 2**progressless_iters (at most MAX_BACKOFF) seconds
 			Adapted from https://code.google.com/p/google-cloud-platform-samples/source/browse/file-transfer-json/chunked_transfer.py?repo=storage
 		'''
 		if progressless_iters > NUM_RETRIES:
 			logger.warning('Failed to make progress for too many consecutive iterations.')
 			raise error
 		
-		sleeptime = random.random() * (2**progressless_iters)
+		sleeptime = random.random() * min(MAX_BACKOFF, 2**progressless_iters)
 		logger.warning('Caught exception (%s). Sleeping for %s seconds before retry #%d.'
 			% (str(error), sleeptime, progressless_iters))
 		time.sleep(sleeptime)
 	
-	def download(self, bucket, object, destination):
-		''' File download in chunks
+	def get_metadata(self, bucket, object):
+		''' Return the size, generation and checksums of an object '''
+		service = self._authenticate_service()
+		return service.objects().get(bucket=bucket, object=object, fields='size,generation,crc32c,md5Hash,mediaLink').execute()
+	
+	def verify(self, destination, meta):
+		''' Check a downloaded file against the object's CRC32C (or MD5 without crcmod)
+			Raises ChecksumMismatchError if they differ
+		'''
+		if crcmod is not None and meta.get('crc32c'): name, expected, digest = 'crc32c', meta['crc32c'], crcmod.predefined.Crc('crc-32c')
+		elif meta.get('md5Hash'): name, expected, digest = 'md5', meta['md5Hash'], md5()
+		else:
+			logger.warning('No usable checksum to verify {0} with'.format(destination))
+			return
+		with open(destination, 'rb') as f:
+			for block in iter(lambda: f.read(HASH_BLOCKSIZE), ''): digest.update(block)
+		if b64encode(digest.digest()) != expected:
+			raise ChecksumMismatchError('{0} of {1} does not match the object ({2})'.format(name, destination, expected))
+	
+	def download(self, bucket, object, destination, resume=False):
+		''' File download in chunks, verified against the object's checksum
+			The object generation is pinned for the whole download and recorded next 
+			to the destination (<destination>.part) until it completes. With resume, 
+			a partial destination of the same generation is continued from its 
+			current size; anything else is downloaded again from the start.
 			Adapted from https://code.google.com/p/google-cloud-platform-samples/source/browse/file-transfer-json/chunked_transfer.py?repo=storage
 		'''
-		self._authenticate_service()
-		f = file(destination,'w')
-		request = self._service.objects().get_media(
-				bucket=bucket
-				,object=object
-		)
-		media = MediaIoBaseDownload(f, request, chunksize=CHUNKSIZE)
-		logger.warning('Downloading bucket {0} to file {1}'.format(bucket,object))
+		meta = self.get_metadata(bucket, object)
+		size, part = int(meta['size']), destination + '.part'
+		offset = 0
+		if resume and os.path.exists(destination):
+			if os.path.exists(part):
+				with open(part, 'r') as f: partial = loads(f.read())
+				if partial.get('generation') == meta['generation']: offset = os.path.getsize(destination)
+			elif os.path.getsize(destination) == size:
+				# Finished earlier; only the checksum decides if it can be kept
+				try:
+					self.verify(destination, meta)
+					logger.warning('{0}/{1} already downloaded to file {2}'.format(bucket,object,destination))
+					return destination
+				except ChecksumMismatchError, err:
+					logger.warning('{0}, downloading again'.format(err))
+			if offset > size: offset = 0
+		with open(part, 'w') as f: f.write(dumps({'bucket': bucket, 'object': object, 'generation': meta['generation']}))
+		if offset: logger.warning('Resuming download of {0}/{1} to file {2} at byte {3}'.format(bucket,object,destination,offset))
+		else: logger.warning('Downloading {0}/{1} to file {2}'.format(bucket,object,destination))
+		# A partial file can already hold every byte if the last run died before verifying it
+		if offset == 0 or offset < size:
+			with open(destination,'ab' if offset else 'wb') as f:
+				self.download_to_fd(bucket, object, f, offset, generation=meta['generation'])
+		try:
+			self.verify(destination, meta)
+		except ChecksumMismatchError:
+			# A corrupt file cannot be resumed
+			os.remove(part)
+			raise
+		os.remove(part)
+		return destination
+	
+	def download_to_fd(self, bucket, object, f, offset=0, generation=None):
+		''' Download an object in chunks into a file-like object, i.e. a pipe 
+			Starts at byte offset of the object, for resuming a partial download, 
+			optionally from a specific object generation
+			Every chunk is its own Range request, so a download can start anywhere
+		'''
+		service = self._authenticate_service()
 		progressless_iters = 0
-		done = False
-		while not done:
+		while True:
 			error = None
+			request = service.objects().get_media(
+					bucket=bucket
+					,object=object
+					,generation=generation
+			)
+			request.headers['range'] = 'bytes={0}-{1}'.format(offset, offset + CHUNKSIZE - 1)
+			responses = []
+			request.add_response_callback(responses.append)
 			try:
-				progress, done = media.next_chunk()
-				if progress:
-					logger.warning(
-						'Download %d%%.' % int(progress.progress() * 100)
-					)
+				content = request.execute()
 			except HttpError, err:
+				# A range past the end: the last chunk ended exactly at the end of the object
+				if err.resp.status == 416: break
 				error = err
-				if err.resp.status < 500:
+				if err.resp.status < 500 and err.resp.status != 429:
 					raise
 			except RETRYABLE_ERRORS, err:
 				error = err
 			
 			if error:
 				progressless_iters += 1
-				handle_progressless_iter(error, progressless_iters)
-			else:
-				progressless_iters = 0
+				self.handle_progressless_iter(error, progressless_iters)
+				continue
+			progressless_iters = 0
+			resp = responses[-1]
+			# Without a Content-Range the whole object was sent
+			if 'content-range' not in resp:
+				f.write(content[offset:])
+				break
+			f.write(content)
+			offset += len(content)
+			size = int(resp['content-range'].rsplit('/', 1)[1])
+			logger.warning('Download %d%%.' % int(100 * offset / max(size, 1)))
+			if offset >= size or not content: break
 		logger.warning('Download complete!')
 	
+	def download_ranged(self, bucket, object, destination, workers=4, chunksize=CHUNKSIZE):
+		''' Download a single object with concurrent HTTP Range requests
+			The destination is preallocated to the object size and each worker writes 
+			its ranges in place. Each worker starts with chunksize byte ranges and 
+			doubles or halves them (up to MAX_RANGE_SIZE) to keep each request near 
+			RANGE_TARGET_SECONDS. A failed range is retried up to NUM_RETRIES times 
+			with exponential backoff. Ranges are read from the object's mediaLink, 
+			which pins its generation, and the file is verified once complete.
+		'''
+		meta = self.get_metadata(bucket, object)
+		size = int(meta['size'])
+		with open(destination, 'wb') as f: f.truncate(size)
+		logger.warning('Downloading {0}/{1} ({2} bytes) to file {3} with {4} workers'.format(bucket,object,size,destination,workers))
+		state = {'offset': 0, 'done': 0}
+		lock = threading.Lock()
+		
+		def next_range(length):
+			with lock:
+				start = state['offset']
+				state['offset'] = min(size, start + length)
+				return start, state['offset']
+		
+		def fetch(http, start, end):
+			resp, content = http.request(meta['mediaLink'], headers={'Range': 'bytes={0}-{1}'.format(start, end - 1)})
+			if resp.status < 500 and resp.status not in (200, 206):
+				raise Exception('Range {0}-{1} of {2} failed with status {3}'.format(start, end - 1, object, resp.status))
+			if resp.status >= 500 or len(content) != end - start:
+				raise IOError('Range {0}-{1} of {2} failed with status {3}'.format(start, end - 1, object, resp.status))
+			return content
+		
+		def worker(n):
+			http = self._authorize()
+			length = chunksize
+			with open(destination, 'r+b') as f:
+				while True:
+					start, end = next_range(length)
+					if start >= end: return
+					retries = 0
+					while True:
+						started = time.time()
+						try:
+							content = fetch(http, start, end)
+							break
+						except RETRYABLE_ERRORS, err:
+							retries += 1
+							if retries > NUM_RETRIES: raise
+							length = max(CHUNKSIZE, length / 2)
+							sleeptime = random.random() * min(MAX_BACKOFF, 2**retries)
+							logger.warning('Range %d-%d failed (%s), retry #%d in %.1f seconds' % (start, end - 1, err, retries, sleeptime))
+							time.sleep(sleeptime)
+					elapsed = time.time() - started
+					f.seek(start)
+					f.write(content)
+					if elapsed < RANGE_TARGET_SECONDS / 2: length = min(MAX_RANGE_SIZE, length * 2)
+					elif elapsed > RANGE_TARGET_SECONDS * 2: length = max(CHUNKSIZE, length / 2)
+					with lock:
+						state['done'] += end - start
+						logger.info('Download %d%%.' % (100 * state['done'] / size))
+		
+		if size > 0:
+			workers = max(1, min(workers, size / chunksize + 1))
+			pool = ThreadPool(workers)
+			try:
+				pool.map(worker, range(workers))
+			finally:
+				pool.close()
+				pool.join()
+		logger.warning('Download complete!')
+		self.verify(destination, meta)
+		return destination
+	
+	def list_objects(self, bucket, prefix=None):
+		''' Return the names of all objects in a bucket, optionally only those starting with prefix '''
+		service = self._authenticate_service()
+		names = []
+		page_token = None
+		while True:
+			res = service.objects().list(
+				bucket=bucket
+				,prefix=prefix
+				,pageToken=page_token
+				,fields='items(name),nextPageToken'
+			).execute()
+			names += [ o['name'] for o in res.get('items',[]) ]
+			page_token = res.get('nextPageToken')
+			if not page_token: return sorted(names)
+	
+	def download_many(self, bucket, objects, destinations, workers=4, resume=False):
+		''' Download several objects concurrently with up to workers threads
+			Args:
+				objects: list of object names
+				destinations: list of local files, one per object
+				resume: continue partial destination files instead of starting over
+		'''
+		if len(objects)!=len(destinations): raise ValueError('Need one destination per object')
+		pool = ThreadPool(max(1,min(workers,len(objects))))
+		try:
+			pool.map(lambda od: self.download(bucket, od[0], od[1], resume), zip(objects,destinations))
+		finally:
+			pool.close()
+			pool.join()
+		logger.warning('Downloaded {0} objects from bucket {1}'.format(len(objects),bucket))
+		return destinations
+	
 	def delete_obj(self, bucket, object):
-		''' Remove an object from a bucket '''
-		self._authenticate_service()
-		request = self._service.objects().delete(
-			bucket=bucket,
-			object=object
-		).execute() 
+		''' Remove an object from a bucket, if it is still there '''
+		service = self._authenticate_service()
+		try:
+			request = service.objects().delete(
+				bucket=bucket,
+				object=object
+			).execute() 
+		except HttpError, err:
+			# Already deleted, i.e. by an earlier run that died before finishing
+			if err.resp.status != 404: raise
+			logger.warning('{0}/{1} was already deleted'.format(bucket, object))
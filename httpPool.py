@@ -0,0 +1,98 @@
+from oauth2client.client import Storage
+import httplib2
+import threading
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+class _CountingHttp(httplib2.Http):
+	''' httplib2.Http that reports every new TCP/TLS connection to its pool '''
+	def __init__(self, on_connect, *args, **kwargs):
+		super(_CountingHttp, self).__init__(*args, **kwargs)
+		self._on_connect = on_connect
+
+	def _conn_request(self, conn, request_uri, method, body, headers):
+		# httplib2 connects lazily, so a missing socket means a fresh handshake
+		if getattr(conn, 'sock', None) is None: self._on_connect()
+		return super(_CountingHttp, self)._conn_request(conn, request_uri, method, body, headers)
+
+class _CountingStore(Storage):
+	''' Credentials store that counts every access token refresh, wherever it
+		is made: by the pool, or by the authorized connections on a 401
+		Delegates to the store the credentials already had, if any.
+	'''
+	def __init__(self, on_refresh, store=None):
+		self._on_refresh = on_refresh
+		self._store = store
+
+	def acquire_lock(self):
+		if self._store: self._store.acquire_lock()
+
+	def release_lock(self):
+		if self._store: self._store.release_lock()
+
+	def locked_get(self):
+		return self._store.locked_get() if self._store else None
+
+	def locked_put(self, credentials):
+		# Also called when a refresh marks the credentials invalid
+		if not credentials.invalid: self._on_refresh()
+		if self._store: self._store.locked_put(credentials)
+
+	def locked_delete(self):
+		if self._store: self._store.locked_delete()
+
+class AuthorizedHttpPool:
+	''' Thread-safe pool of authorized, keep-alive HTTP connections
+		Each thread is handed its own httplib2.Http (they are not thread-safe),
+		which is reused for every call that thread makes. All connections share
+		one set of credentials, and the access token is only refreshed when it
+		is missing or has expired.
+	'''
+	def __init__(self, credentials):
+		''' Args:
+				credentials: oauth2client credentials shared by all connections
+		'''
+		self._credentials = credentials
+		self._local = threading.local()
+		# Guards the counters only; refreshing holds _refresh_lock, and may count handshakes meanwhile
+		self._lock = threading.Lock()
+		self._refresh_lock = threading.Lock()
+		self._refresh_http = None
+		self._stats = {'connections': 0, 'handshakes': 0, 'token_refreshes': 0}
+		if hasattr(credentials, 'set_store'):
+			credentials.set_store(_CountingStore(lambda: self._count('token_refreshes'), credentials.store))
+
+	def _count(self, key):
+		with self._lock:
+			self._stats[key] += 1
+
+	def _new_http(self):
+		return _CountingHttp(lambda: self._count('handshakes'))
+
+	def _token_expired(self):
+		if not self._credentials.access_token: return True
+		return getattr(self._credentials, 'access_token_expired', False)
+
+	def _refresh_if_needed(self):
+		''' Refresh the shared access token once, only when it has expired '''
+		if not self._token_expired(): return
+		with self._refresh_lock:
+			if not self._token_expired(): return
+			if self._refresh_http is None: self._refresh_http = self._new_http()
+			logger.info('Refreshing access token')
+			self._credentials.refresh(self._refresh_http)
+
+	def get(self):
+		''' Return the authorized connection for the calling thread '''
+		self._refresh_if_needed()
+		http = getattr(self._local, 'http', None)
+		if http is None:
+			http = self._local.http = self._credentials.authorize(self._new_http())
+			self._count('connections')
+		return http
+
+	def stats(self):
+		''' Return counters of connections, handshakes and token refreshes '''
+		with self._lock:
+			return dict(self._stats)
@@ -0,0 +1,190 @@
+from apiclient.http import HttpRequest
+from contextlib import contextmanager
+from json import dumps
+from time import time
+import os, threading
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def _ms(job_resource, key):
+	value = job_resource.get('statistics', {}).get(key)
+	return int(value) if value is not None else None
+
+@contextmanager
+def _untimed():
+	yield
+
+def timed(metrics, name, destination=None):
+	''' Time a block as a stage of metrics, or do nothing without metrics '''
+	return metrics.stage(name, destination) if metrics else _untimed()
+
+class Metrics:
+	''' Thread-safe collector of where a run spends its time
+		Records wall time per pipeline stage, count and latency of every API
+		call, bytes and throughput per transfer, rows loaded and rejected per
+		Vertica load, and the statistics of every finished BigQuery job. Stages,
+		transfers and loads are labelled with the destination they belong to, so
+		one collector can be shared by the specs of a batch.
+	'''
+	def __init__(self, run=None):
+		''' Args:
+				run: optional dict describing the run, copied into the report
+		'''
+		self.run = run or {}
+		self.started_at = time()
+		self._lock = threading.Lock()
+		self._stages = {}
+		self._calls = {}
+		self._transfers = {}
+		self._loads = []
+		self._jobs = []
+
+	def _return_self(self):
+		return 'Metrics: {0} stages, {1} API calls, {2} jobs'.format(
+			len(self._stages), sum([ c['count'] for c in self._calls.values() ]), len(self._jobs))
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	@contextmanager
+	def stage(self, name, destination=None):
+		''' Time a block of work as a stage, i.e. with metrics.stage('download', 'dataset.table'): '''
+		started = time()
+		try:
+			yield
+		finally:
+			with self._lock:
+				stage = self._stages.setdefault((destination, name), {'count': 0, 'seconds': 0.0})
+				stage['count'] += 1
+				stage['seconds'] += time() - started
+
+	def record_call(self, method, seconds, error=False):
+		''' Record one API call of a method, i.e. bigquery.jobs.get '''
+		with self._lock:
+			call = self._calls.setdefault(method, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+			call['count'] += 1
+			call['errors'] += 1 if error else 0
+			call['seconds'] += seconds
+			call['max_seconds'] = max(call['max_seconds'], seconds)
+
+	def record_transfer(self, kind, nbytes, seconds, destination=None):
+		''' Record bytes moved by a transfer, i.e. a download or direct table read '''
+		with self._lock:
+			transfer = self._transfers.setdefault((destination, kind), {'count': 0, 'bytes': 0, 'seconds': 0.0})
+			transfer['count'] += 1
+			transfer['bytes'] += nbytes
+			transfer['seconds'] += seconds
+
+	def record_load(self, report, destination=None):
+		''' Record the report of a Vertica load (see VerticaCopyRunner.report) '''
+		with self._lock:
+			self._loads.append({
+				'destination': destination
+				,'table': report['table']
+				,'files': report['files']
+				,'rows_loaded': report['rows_loaded']
+				,'rows_rejected': report['rows_rejected']
+			})
+
+	def record_job(self, job_resource):
+		''' Record the statistics of a finished BigQuery job '''
+		stats = job_resource.get('statistics', {})
+		query = stats.get('query', {})
+		created, started, ended = _ms(job_resource,'creationTime'), _ms(job_resource,'startTime'), _ms(job_resource,'endTime')
+		job = {
+			'job_id': job_resource['jobReference']['jobId']
+			,'type': ([ k for k in ('query','extract','load','copy') if k in job_resource.get('configuration', {}) ] or [None])[0]
+			,'failed': bool(job_resource.get('status', {}).get('errorResult'))
+			,'total_bytes_processed': int(stats.get('totalBytesProcessed', 0))
+			,'total_bytes_billed': int(query.get('totalBytesBilled', 0))
+			,'slot_ms': int(query.get('totalSlotMs', 0))
+			,'cache_hit': query.get('cacheHit', False)
+			,'queue_seconds': (started - created) / 1000.0 if started and created else None
+			,'run_seconds': (ended - started) / 1000.0 if ended and started else None
+		}
+		with self._lock: self._jobs.append(job)
+
+	def request_builder(self):
+		''' Return an apiclient HttpRequest class that records every request it executes here '''
+		metrics = self
+		class TimedHttpRequest(HttpRequest):
+			def execute(self, *args, **kwargs):
+				started = time()
+				try:
+					result = HttpRequest.execute(self, *args, **kwargs)
+				except Exception:
+					metrics.record_call(self.methodId, time() - started, error=True)
+					raise
+				metrics.record_call(self.methodId, time() - started)
+				return result
+		return TimedHttpRequest
+
+	def report(self):
+		''' Return everything recorded so far as a JSON-serializable dict '''
+		with self._lock:
+			return {
+				'run': self.run
+				,'started_at': self.started_at
+				,'seconds': time() - self.started_at
+				,'stages': [ dict(s, destination=d, stage=n) for (d,n),s in sorted(self._stages.items()) ]
+				,'api_calls': [ dict(c, method=m) for m,c in sorted(self._calls.items()) ]
+				,'transfers': [ dict(t, destination=d, kind=k, bytes_per_second=t['bytes'] / t['seconds'] if t['seconds'] else None)
+					for (d,k),t in sorted(self._transfers.items()) ]
+				,'loads': list(self._loads)
+				,'jobs': list(self._jobs)
+				,'totals': {
+					'bytes_processed': sum([ j['total_bytes_processed'] for j in self._jobs ])
+					,'slot_ms': sum([ j['slot_ms'] for j in self._jobs ])
+					,'rows_loaded': sum([ l['rows_loaded'] or 0 for l in self._loads ])
+					,'rows_rejected': sum([ l['rows_rejected'] for l in self._loads ])
+				}
+			}
+
+	def _write(self, path, content):
+		''' Write atomically, so collectors never read a partial file '''
+		tmp = path + '.tmp'
+		with open(tmp, 'w') as f: f.write(content)
+		os.rename(tmp, path)
+
+	def write_json(self, path):
+		''' Write the report as JSON '''
+		self._write(path, dumps(self.report(), indent=1, sort_keys=True))
+		logger.warning('Wrote run report to {0}'.format(path))
+
+	def prometheus(self, prefix='bqimporter'):
+		''' Return the report in the Prometheus text format '''
+		report = self.report()
+		lines = []
+		def metric(name, kind, help, samples):
+			lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help))
+			lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+			for labels, value in samples:
+				label_str = ','.join([ '{0}="{1}"'.format(k, str(v).replace('\\','\\\\').replace('"','\\"')) for k,v in sorted(labels.items()) if v is not None ])
+				lines.append('{0}_{1}{2} {3}'.format(prefix, name, '{'+label_str+'}' if label_str else '', value))
+		metric('run_seconds', 'gauge', 'Wall time of the run', [ ({}, report['seconds']) ])
+		metric('last_run_timestamp_seconds', 'gauge', 'Start time of the run', [ ({}, report['started_at']) ])
+		metric('stage_seconds', 'gauge', 'Wall time per pipeline stage', [ ({'destination': s['destination'], 'stage': s['stage']}, s['seconds']) for s in report['stages'] ])
+		metric('api_calls', 'gauge', 'API calls per method', [ ({'method': c['method']}, c['count']) for c in report['api_calls'] ])
+		metric('api_call_errors', 'gauge', 'Failed API calls per method', [ ({'method': c['method']}, c['errors']) for c in report['api_calls'] ])
+		metric('api_call_seconds', 'gauge', 'Total latency of API calls per method', [ ({'method': c['method']}, c['seconds']) for c in report['api_calls'] ])
+		metric('transfer_bytes', 'gauge', 'Bytes transferred', [ ({'destination': t['destination'], 'kind': t['kind']}, t['bytes']) for t in report['transfers'] ])
+		metric('transfer_seconds', 'gauge', 'Time spent transferring', [ ({'destination': t['destination'], 'kind': t['kind']}, t['seconds']) for t in report['transfers'] ])
+		loads = {}
+		for l in report['loads']:
+			rows = loads.setdefault((l['destination'], l['table']), [0, 0])
+			rows[0] += l['rows_loaded'] or 0
+			rows[1] += l['rows_rejected']
+		metric('rows_loaded', 'gauge', 'Rows loaded into Vertica', [ ({'destination': d, 'table': t}, rows[0]) for (d,t),rows in sorted(loads.items()) ])
+		metric('rows_rejected', 'gauge', 'Rows rejected by Vertica', [ ({'destination': d, 'table': t}, rows[1]) for (d,t),rows in sorted(loads.items()) ])
+		metric('bytes_processed', 'gauge', 'Bytes processed by BigQuery jobs', [ ({}, report['totals']['bytes_processed']) ])
+		metric('slot_ms', 'gauge', 'Slot milliseconds used by BigQuery jobs', [ ({}, report['totals']['slot_ms']) ])
+		return '\n'.join(lines) + '\n'
+
+	def write_prometheus(self, path, prefix='bqimporter'):
+		''' Write the report as a Prometheus textfile collector file (*.prom) '''
+		self._write(path, self.prometheus(prefix))
+		logger.warning('Wrote Prometheus metrics to {0}'.format(path))
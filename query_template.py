@@ -1,4 +1,5 @@
 TABLE_MATCH_RE = r'(''web_sessions_'')(?P<datenum>\d{8})'
+TABLE_NAME = 'web_sessions_{0:%Y%m%d}'
 SCHEMA = [
 	{'name': 'Col1', 'type': 'STRING', 'mode': 'nullable'},
 	{'name': 'Col2', 'type': 'TIMESTAMP', 'mode': 'nullable'},
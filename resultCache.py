@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import logging
+from json import dumps, loads
+from time import time
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+class QueryResultCache:
+	''' On-disk record of the query result each BigQuery destination table holds
+		Keeps, per destination, the fingerprint of the query that last wrote it
+		(rendered query and source table modification times) together with the
+		table's lastModifiedTime right after, so a later run can tell the table
+		still holds that result. Also keeps the URIs the result was exported to,
+		until the caller reports the exported objects removed.
+	'''
+	def __init__(self, path):
+		''' Args:
+				path: sqlite file to keep the cache in (created if necessary)
+		'''
+		self.path = path
+		self._lock = threading.Lock()
+		self._execute('''CREATE TABLE IF NOT EXISTS query_results (
+			destination TEXT NOT NULL PRIMARY KEY
+			,fingerprint TEXT NOT NULL
+			,table_modified INTEGER
+			,exported_uris TEXT
+			,updated_at REAL NOT NULL
+		)''')
+
+	def _return_self(self):
+		return 'Query result cache: {0}'.format(self.path)
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _execute(self, sql, params=()):
+		''' Run one statement on a short-lived connection, so the cache can be shared across threads '''
+		with self._lock:
+			conn = sqlite3.connect(self.path, timeout=30)
+			try:
+				with conn:
+					return conn.execute(sql, params).fetchall()
+			finally:
+				conn.close()
+
+	def get(self, destination):
+		''' Return a dict with fingerprint, table_modified and exported_uris, or None if nothing is recorded '''
+		rows = self._execute('SELECT fingerprint, table_modified, exported_uris FROM query_results WHERE destination=?', (destination,))
+		if not rows: return None
+		fingerprint, table_modified, exported_uris = rows[0]
+		return {'fingerprint': fingerprint, 'table_modified': table_modified, 'exported_uris': loads(exported_uris) if exported_uris else None}
+
+	def put(self, destination, fingerprint, table_modified):
+		''' Record the result a query just wrote to destination (forgetting any earlier export) '''
+		self._execute('INSERT OR REPLACE INTO query_results VALUES (?,?,?,NULL,?)', (destination,fingerprint,table_modified,time()))
+
+	def set_exported(self, destination, uris):
+		''' Record the URIs the current result of destination was exported to, or None once they are removed '''
+		self._execute('UPDATE query_results SET exported_uris=?, updated_at=? WHERE destination=?'
+			,(dumps(uris) if uris else None,time(),destination))
+
+	def invalidate(self, destination):
+		''' Forget the result of destination, so its query runs again '''
+		self._execute('DELETE FROM query_results WHERE destination=?', (destination,))
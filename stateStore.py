@@ -0,0 +1,67 @@
+import sqlite3
+import threading
+import logging
+from time import time
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+class LoadStateStore:
+	''' On-disk record of the daily source tables each destination has loaded
+		Keeps, per destination, the lastModifiedTime every (dataset, table) had when
+		it was exported and loaded, so later runs can skip tables that have not changed
+	'''
+	def __init__(self, path):
+		''' Args:
+				path: sqlite file to keep the state in (created if necessary)
+		'''
+		self.path = path
+		self._lock = threading.Lock()
+		self._execute('''CREATE TABLE IF NOT EXISTS loaded_tables (
+			destination TEXT NOT NULL
+			,dataset TEXT NOT NULL
+			,table_id TEXT NOT NULL
+			,table_date TEXT
+			,last_modified INTEGER
+			,loaded_at REAL NOT NULL
+			,PRIMARY KEY (destination, dataset, table_id)
+		)''')
+
+	def _return_self(self):
+		return 'Load state: {0}'.format(self.path)
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _execute(self, sql, params=(), many=False):
+		''' Run one statement on a short-lived connection, so the store can be shared across threads '''
+		with self._lock:
+			conn = sqlite3.connect(self.path, timeout=30)
+			try:
+				with conn:
+					if many: return conn.executemany(sql, params).fetchall()
+					return conn.execute(sql, params).fetchall()
+			finally:
+				conn.close()
+
+	def get_loaded(self, destination):
+		''' Return {(dataset, table_id): last_modified} of every table loaded into destination '''
+		rows = self._execute('SELECT dataset, table_id, last_modified FROM loaded_tables WHERE destination=?', (destination,))
+		return dict(((d,t),m) for d,t,m in rows)
+
+	def mark_loaded(self, destination, tables):
+		''' Record tables as loaded into destination
+			Args:
+				tables: list of (dataset, table_id, table_date, last_modified) tuples
+		'''
+		now = time()
+		self._execute('INSERT OR REPLACE INTO loaded_tables VALUES (?,?,?,?,?,?)'
+			,[ (destination,d,t,dt,m,now) for d,t,dt,m in tables ], many=True)
+		logger.warning('Recorded {0} tables as loaded into {1}'.format(len(tables),destination))
+
+	def forget(self, destination, startdt=None, enddt=None):
+		''' Drop the state of a destination, optionally only for table dates in [startdt, enddt], so they are reloaded '''
+		if startdt is None: self._execute('DELETE FROM loaded_tables WHERE destination=?', (destination,))
+		else: self._execute('DELETE FROM loaded_tables WHERE destination=? AND table_date BETWEEN ? AND ?', (destination,startdt,enddt))
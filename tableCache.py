@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+import logging
+from json import dumps, loads
+from time import time
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+class TableListCache:
+	''' On-disk cache of BigQuery table listings, keyed by project and dataset
+		Listings are served from disk while younger than ttl seconds. Once a listing
+		is older than that it can be refreshed incrementally (only probing for tables
+		newer than the last seen date suffix) until it is older than full_ttl
+		seconds, after which the dataset is listed again in full. At most
+		max_entries datasets are kept, evicting the least recently used.
+	'''
+	def __init__(self, path, ttl=3600, full_ttl=7*24*3600, max_entries=1000):
+		''' Args:
+				path: sqlite file to keep listings in (created if necessary)
+				ttl: seconds a listing is served without any refresh
+				full_ttl: seconds before incremental refreshes give way to a full listing
+				max_entries: maximum number of datasets kept in the cache
+		'''
+		self.path = path
+		self.ttl = ttl
+		self.full_ttl = full_ttl
+		self.max_entries = max_entries
+		self._lock = threading.Lock()
+		self._execute('''CREATE TABLE IF NOT EXISTS table_lists (
+			project TEXT NOT NULL
+			,dataset TEXT NOT NULL
+			,tables TEXT NOT NULL
+			,listed_at REAL NOT NULL
+			,refreshed_at REAL NOT NULL
+			,accessed_at REAL NOT NULL
+			,PRIMARY KEY (project, dataset)
+		)''')
+
+	def _return_self(self):
+		return 'Table cache: {0} (ttl {1}s, full ttl {2}s, max {3} entries)'.format(
+			self.path,self.ttl,self.full_ttl,self.max_entries)
+
+	def __str__(self):
+		return self._return_self()
+
+	def __repr__(self):
+		return self._return_self()
+
+	def _execute(self, sql, params=()):
+		''' Run one statement on a short-lived connection, so the cache can be shared across threads '''
+		with self._lock:
+			conn = sqlite3.connect(self.path, timeout=30)
+			try:
+				with conn:
+					return conn.execute(sql, params).fetchall()
+			finally:
+				conn.close()
+
+	def get(self, project, dataset):
+		''' Return a dict with tables, listed_at and refreshed_at, or None if not cached '''
+		rows = self._execute('SELECT tables, listed_at, refreshed_at FROM table_lists WHERE project=? AND dataset=?'
+			,(str(project),dataset))
+		if not rows: return None
+		self._execute('UPDATE table_lists SET accessed_at=? WHERE project=? AND dataset=?', (time(),str(project),dataset))
+		tables, listed_at, refreshed_at = rows[0]
+		return {'tables': loads(tables), 'listed_at': listed_at, 'refreshed_at': refreshed_at}
+
+	def is_fresh(self, entry):
+		''' True if a cached listing can be used as-is '''
+		return time() - entry['refreshed_at'] < self.ttl
+
+	def can_refresh(self, entry):
+		''' True if a cached listing is recent enough to be refreshed incrementally '''
+		return time() - entry['listed_at'] < self.full_ttl
+
+	def put(self, project, dataset, tables, listed_at=None):
+		''' Store a listing
+			Args:
+				tables: list of table ids
+				listed_at: time of the last full listing (defaults to now, i.e. a full listing)
+		'''
+		now = time()
+		self._execute('INSERT OR REPLACE INTO table_lists VALUES (?,?,?,?,?,?)'
+			,(str(project),dataset,dumps(sorted(tables)),listed_at or now,now,now))
+		self._evict()
+
+	def invalidate(self, project, dataset=None):
+		''' Drop one dataset, or every dataset of a project, from the cache '''
+		if dataset is None: self._execute('DELETE FROM table_lists WHERE project=?', (str(project),))
+		else: self._execute('DELETE FROM table_lists WHERE project=? AND dataset=?', (str(project),dataset))
+
+	def _evict(self):
+		''' Keep at most max_entries listings, dropping the least recently used '''
+		self._execute('''DELETE FROM table_lists WHERE rowid NOT IN (
+			SELECT rowid FROM table_lists ORDER BY accessed_at DESC LIMIT ?
+		)''', (self.max_entries,))